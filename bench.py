@@ -0,0 +1,394 @@
+"""Load test for the storefront's hot routes.
+
+Seeds a synthetic catalog, users and order history into a throwaway SQLite database, then drives
+home, category pages, item pages, add-to-cart, checkout and success from concurrent virtual shoppers
+with Stripe stubbed out, and reports p50/p95/p99 latency and req/s per route.
+
+    python bench.py --items 2000 --users 200 --requests 5000 --concurrency 16
+    python bench.py --server                       # through a local WSGI server instead of the test client
+    python bench.py --record trace.jsonl           # save the requests that were sent
+    python bench.py --replay trace.jsonl           # send exactly those requests again
+
+    # Checkout against a local fake Stripe that takes 500ms per call, 8 server threads
+    python bench.py --server --threads 8 --fake-stripe --stripe-latency 500
+    python bench.py --server --threads 8 --fake-stripe --stripe-latency 500 --asgi   # under uvicorn
+"""
+import http.client
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import click
+
+ROUTES = ["home", "category", "item", "cart_add", "checkout", "success"]
+# Share of shopping sessions that add to the cart, and of those that go on to pay
+ADD_TO_CART_RATE = 0.6
+CHECKOUT_RATE = 0.3
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def stub_stripe(latency):
+    """Replace the Stripe calls made while shopping with local fakes that sleep for `latency` seconds."""
+    import stripe
+
+    sessions = {}
+    ids = itertools.count(1)
+    lock = threading.Lock()
+
+    def create_session(**params):
+        time.sleep(latency)
+        with lock:
+            session_id = f"cs_bench_{next(ids)}"
+        session = {
+            "id": session_id,
+            "object": "checkout.session",
+            "url": f"https://checkout.stripe.test/pay/{session_id}",
+            "expires_at": params["expires_at"],
+            "payment_status": "paid",
+            "metadata": {key: str(value) for key, value in params["metadata"].items()},
+        }
+        sessions[session_id] = session
+        return stripe.StripeObject.construct_from(session, "sk_bench")
+
+    def retrieve_session(session_id, **params):
+        time.sleep(latency)
+        return stripe.StripeObject.construct_from(sessions[session_id], "sk_bench")
+
+    stripe.checkout.Session.create = create_session
+    stripe.checkout.Session.retrieve = retrieve_session
+
+
+def serve_fake_stripe(latency):
+    """Start a local HTTP server answering the Checkout Session calls, `latency` seconds per call. Returns its base URL."""
+    sessions = {}
+    ids = itertools.count(1)
+
+    class FakeStripeHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+            time.sleep(latency)
+            if self.path != "/v1/checkout/sessions":
+                return self.send_json(404, {"error": {"message": f"Unrecognized request URL ({self.path})"}})
+            session_id = f"cs_bench_{next(ids)}"
+            sessions[session_id] = {
+                "id": session_id,
+                "object": "checkout.session",
+                "url": f"https://checkout.stripe.test/pay/{session_id}",
+                "expires_at": int(form["expires_at"][0]),
+                "payment_status": "paid",
+                "metadata": {key[len("metadata["):-1]: values[0] for key, values in form.items() if key.startswith("metadata[")},
+            }
+            self.send_json(200, sessions[session_id])
+
+        def do_GET(self):
+            time.sleep(latency)
+            session = sessions.get(self.path.rsplit("/", 1)[-1])
+            if session is None:
+                return self.send_json(404, {"error": {"message": "No such checkout.session"}})
+            self.send_json(200, session)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeStripeHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://{httpd.server_address[0]}:{httpd.server_address[1]}"
+
+
+def serve_app(app, threads):
+    """Serve the app on a local WSGI server, with a fixed pool of `threads` workers (0 for a thread per request)."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    httpd = make_server("127.0.0.1", 0, app, threaded=not threads, request_handler=QuietHandler)
+    if threads:
+        # Like a gthread worker: requests beyond the pool wait for a free thread
+        pool = ThreadPoolExecutor(max_workers=threads)
+
+        def handle(request, client_address):
+            try:
+                httpd.finish_request(request, client_address)
+            except Exception:
+                httpd.handle_error(request, client_address)
+            finally:
+                httpd.shutdown_request(request)
+
+        httpd.process_request = lambda request, client_address: pool.submit(handle, request, client_address)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+class ASGIServer:
+    """Serve the app's ASGI entry point on uvicorn, with `threads` pool threads for the Flask views (needs uvicorn)."""
+
+    def __init__(self, main, threads):
+        import socket
+        import uvicorn
+
+        if threads:
+            main.app.config["ASGI_THREADS"] = threads
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.server_address = sock.getsockname()
+        self.server = uvicorn.Server(uvicorn.Config(main.create_asgi_app(), log_level="warning", lifespan="off"))
+        threading.Thread(target=self.server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def shutdown(self):
+        self.server.should_exit = True
+
+
+def seed(main, items, users, orders, rng):
+    """Bulk-insert a synthetic catalog, shoppers and order history. Returns (item ids, category slugs)."""
+    db = main.db
+    categories = list(main.CATEGORIES)
+    password = main.hasher.hash("bench")
+    now = datetime.now(timezone.utc)
+
+    db.session.execute(db.insert(main.Item), [
+        {"stripe_prod_id": f"prod_bench_{n}", "stripe_price_id": f"price_bench_{n}", "name": f"Bench item {n}",
+         "category": categories[n % len(categories)], "price": rng.randint(200, 5000), "unit": "oz",
+         "unit_amt": rng.choice([4.0, 8.0, 12.0, 16.0]), "description": f"Synthetic item {n} for load testing",
+         "img_url": "", "stock": 10 ** 9}
+        for n in range(1, items + 1)
+    ])
+    # User 1 is the admin; shoppers start at 2
+    db.session.execute(db.insert(main.User), [
+        {"username": f"shopper{n}", "email": f"shopper{n}@bench.test", "password": password, "clearance": n == 1}
+        for n in range(1, users + 2)
+    ])
+    db.session.commit()
+
+    item_ids = db.session.execute(db.select(main.Item.id).order_by(main.Item.id)).scalars().all()
+    for start in range(0, orders, 1000):
+        batch = range(start, min(start + 1000, orders))
+        order_ids = db.session.execute(
+            db.insert(main.Order).returning(main.Order.id),
+            [{"user_id": rng.randint(2, users + 1), "date": "", "created_at": now - timedelta(minutes=rng.randint(1, 525600)),
+              "stripe_session_id": f"cs_seed_{n}"} for n in batch],
+        ).scalars().all()
+        db.session.execute(db.insert(main.OrderItem), [
+            {"order_id": order_id, "item_id": rng.choice(item_ids), "quantity": rng.randint(1, 3), "price": rng.randint(200, 5000)}
+            for order_id in order_ids for _ in range(rng.randint(1, 4))
+        ])
+        db.session.commit()
+    main.catalog.invalidate()
+    return item_ids, categories
+
+
+def plan_sessions(item_ids, categories, users, requests, rng):
+    """Build each shopper's request sequence up front so a run can be recorded and replayed exactly."""
+    # Popularity falls off with rank so a few items stay hot, as on a real storefront
+    weights = [1 / rank for rank in range(1, len(item_ids) + 1)]
+    plan = defaultdict(list)
+    planned = 0
+    while planned < requests:
+        user_id = rng.randint(2, users + 1)
+        steps = [("home", "/"), ("category", f"/category/{rng.choice(categories)}")]
+        viewed = rng.choices(item_ids, weights, k=rng.randint(1, 3))
+        steps += [("item", f"/item/{item_id}") for item_id in viewed]
+        if rng.random() < ADD_TO_CART_RATE:
+            steps += [("cart_add", f"/add-to-cart/{item_id}/plus") for item_id in viewed]
+            if rng.random() < CHECKOUT_RATE:
+                # The session id is only known once checkout redirects to Stripe
+                steps += [("checkout", "/create-checkout-session"), ("success", "/success?session_id={session_id}")]
+        plan[user_id] += steps
+        planned += len(steps)
+    return plan
+
+
+class TestClientShopper:
+    def __init__(self, app, user_id):
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session["_user_id"] = str(user_id)
+            session["_fresh"] = True
+
+    def get(self, path):
+        response = self.client.get(path)
+        response.close()
+        return response.status_code, response.headers.get("Location")
+
+
+class HTTPShopper:
+    def __init__(self, app, user_id, address):
+        self.address = address
+        self.cookie_name = app.config["SESSION_COOKIE_NAME"]
+        self.cookie = app.session_interface.get_signing_serializer(app).dumps({"_user_id": str(user_id), "_fresh": True})
+
+    def get(self, path):
+        connection = http.client.HTTPConnection(*self.address)
+        try:
+            connection.request("GET", path, headers={"Cookie": f"{self.cookie_name}={self.cookie}"})
+            response = connection.getresponse()
+            response.read()
+            for header in response.headers.get_all("Set-Cookie") or []:
+                morsel = SimpleCookie(header).get(self.cookie_name)
+                if morsel is not None:
+                    self.cookie = morsel.value
+            return response.status, response.headers.get("Location")
+        finally:
+            connection.close()
+
+
+def run_plan(plan, make_shopper, concurrency):
+    """Run every shopper's sequence, `concurrency` shoppers at a time. Returns (trace entries, wall time)."""
+    trace = []
+    lock = threading.Lock()
+    started = time.perf_counter()
+
+    def shop(user_id):
+        shopper = make_shopper(user_id)
+        session_id = None
+        entries = []
+        for route, path in plan[user_id]:
+            if "{session_id}" in path:
+                if session_id is None:
+                    continue
+                path = path.replace("{session_id}", session_id)
+            request_started = time.perf_counter()
+            status, location = shopper.get(path)
+            elapsed = time.perf_counter() - request_started
+            if route == "checkout":
+                session_id = location.rsplit("/", 1)[-1] if location and "/pay/" in location else None
+            entries.append({"at": round(request_started - started, 6), "user": user_id, "route": route,
+                            "method": "GET", "path": path, "status": status, "ms": round(elapsed * 1000, 3)})
+        with lock:
+            trace.extend(entries)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # Consume the results so a shopper's exception surfaces here
+        list(pool.map(shop, list(plan)))
+    return sorted(trace, key=lambda entry: entry["at"]), time.perf_counter() - started
+
+
+def report(trace, elapsed):
+    by_route = defaultdict(list)
+    errors = defaultdict(int)
+    for entry in trace:
+        by_route[entry["route"]].append(entry["ms"])
+        if entry["status"] >= 500:
+            errors[entry["route"]] += 1
+
+    click.echo(f"{'route':<10} {'requests':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'5xx':>5}")
+    for route in ROUTES + sorted(set(by_route) - set(ROUTES)):
+        samples = by_route.get(route)
+        if not samples:
+            continue
+        click.echo(f"{route:<10} {len(samples):>8} {len(samples) / elapsed:>8.1f} {percentile(samples, 50):>8.2f} "
+                   f"{percentile(samples, 95):>8.2f} {percentile(samples, 99):>8.2f} {errors[route]:>5}")
+    click.echo(f"{'total':<10} {len(trace):>8} {len(trace) / elapsed:>8.1f}  in {elapsed:.2f}s")
+
+
+@click.command()
+@click.option("--items", default=2000, help="Catalog size.")
+@click.option("--users", default=200, help="Number of shoppers.")
+@click.option("--orders", default=5000, help="Orders of seeded purchase history.")
+@click.option("--requests", default=5000, help="Approximate number of requests to send.")
+@click.option("--concurrency", default=16, help="Shoppers browsing at the same time.")
+@click.option("--seed", "random_seed", default=1, help="Random seed for the data and the request mix.")
+@click.option("--stripe-latency", default=0.0, help="Simulated Stripe API latency in milliseconds.")
+@click.option("--fake-stripe", is_flag=True, help="Call a local fake Stripe server over HTTP instead of stubbing the SDK.")
+@click.option("--server", is_flag=True, help="Send requests through a local threaded WSGI server.")
+@click.option("--threads", default=0, help="With --server, fixed number of server threads (0 for one per request).")
+@click.option("--asgi", is_flag=True, help="With --server, serve main:create_asgi_app on uvicorn instead of WSGI.")
+@click.option("--record", type=click.Path(dir_okay=False, writable=True), help="Write the request trace to this JSONL file.")
+@click.option("--replay", type=click.Path(exists=True, dir_okay=False), help="Replay a trace written by --record.")
+def bench(items, users, orders, requests, concurrency, random_seed, stripe_latency, fake_stripe, server,
+          threads, asgi, record, replay):
+    """Benchmark the storefront's hot routes against a throwaway database."""
+    if replay:
+        with open(replay) as trace_file:
+            header = json.loads(trace_file.readline())["bench"]
+            recorded = [json.loads(line) for line in trace_file if line.strip()]
+        items, users, orders, random_seed = header["items"], header["users"], header["orders"], header["seed"]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Point the app at a scratch database and keep background workers off before it is imported
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        os.environ.setdefault("SECRET_KEY", "bench")
+        os.environ.setdefault("DOMAIN", "http://localhost/")
+        os.environ.pop("STRIPE_WEBHOOK_SECRET", None)
+        os.environ["STRIPE_SYNC_WORKER"] = os.environ["STOCK_SWEEPER"] = "0"
+        if fake_stripe:
+            os.environ["STRIPE_API_BASE"] = serve_fake_stripe(stripe_latency / 1000)
+            os.environ["STRIPE_SECRET_KEY"] = "sk_test_bench"
+        import main
+
+        if not fake_stripe:
+            stub_stripe(stripe_latency / 1000)
+        rng = random.Random(random_seed)
+        started = time.perf_counter()
+        with main.app.app_context():
+            main.init_db()
+            item_ids, categories = seed(main, items, users, orders, rng)
+        click.echo(f"Seeded {items} items, {users} shoppers and {orders} orders in {time.perf_counter() - started:.1f}s")
+
+        if replay:
+            plan = defaultdict(list)
+            for entry in recorded:
+                path = entry["path"]
+                if entry["route"] == "success":
+                    path = "/success?session_id={session_id}"
+                plan[entry["user"]].append((entry["route"], path))
+        else:
+            plan = plan_sessions(item_ids, categories, users, requests, rng)
+
+        httpd = None
+        if server:
+            httpd = ASGIServer(main, threads) if asgi else serve_app(main.app, threads)
+            make_shopper = lambda user_id: HTTPShopper(main.app, user_id, httpd.server_address)
+        else:
+            make_shopper = lambda user_id: TestClientShopper(main.app, user_id)
+
+        # Warm the catalog cache and templates so the first shopper doesn't pay for them
+        make_shopper(2).get("/")
+        try:
+            trace, elapsed = run_plan(plan, make_shopper, concurrency)
+        finally:
+            if httpd is not None:
+                httpd.shutdown()
+        report(trace, elapsed)
+
+        if record:
+            with open(record, "w") as trace_file:
+                trace_file.write(json.dumps({"bench": {"items": items, "users": users, "orders": orders, "seed": random_seed}}) + "\n")
+                for entry in trace:
+                    trace_file.write(json.dumps(entry) + "\n")
+            click.echo(f"Recorded {len(trace)} requests to {record}")
+
+        with main.app.app_context():
+            main.db.engine.dispose()
+
+
+if __name__ == "__main__":
+    bench()
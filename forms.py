@@ -1,23 +1,35 @@
 from decimal import Decimal
 from flask_wtf import FlaskForm
-from wtforms import DecimalField, FileField, IntegerField, SelectField, StringField, SubmitField, PasswordField
-from wtforms.validators import DataRequired, URL
-from flask_ckeditor import CKEditorField
+from wtforms import DecimalField, FileField, HiddenField, IntegerField, SelectField, StringField, SubmitField, PasswordField
+from wtforms.validators import DataRequired, NumberRange, URL
+
+
+# Product categories (value stored on Item.category, display label)
+CATEGORY_CHOICES = [("syrup", "Syrup"), ("hotsauce", "Hot Sauce"), ("jam", "Jam/Jelly")]
 
 
 # Item Form
 class ItemForm(FlaskForm):
     name = StringField("Product Name", validators=[DataRequired()])
-    category = SelectField("Product Type", choices=[("syrup", "Syrup"), ("hotsauce", "Hot Sauce"), ("jam", "Jam/Jelly")], coerce=str,  validators=[DataRequired()])
+    category = SelectField("Product Type", choices=CATEGORY_CHOICES, coerce=str,  validators=[DataRequired()])
     price = IntegerField("USD Price (in cents)", validators=[DataRequired()])
     unit = SelectField("Weight/Volume Unit (oz, g, or ml)", choices=[("oz", "Ounces"), ("g", "Grams"), ("ml", "Milliliters")], validators=[DataRequired()])
     unit_amt = DecimalField("Weight/Volume Amount", places=1, validators=[DataRequired()])
     img_url = StringField("Product Image URL", validators=[DataRequired(), URL()])
     stock = IntegerField("Stock")
+    # Stock the edit form was rendered with, so an edit applies the admin's change rather than a stale absolute value
+    original_stock = HiddenField()
     description = StringField("Item Description", validators=[DataRequired()])
     submit = SubmitField("Save Changes")
 
 
+# Bulk Reprice Form
+class RepriceForm(FlaskForm):
+    category = SelectField("Product Type", choices=[("", "All products")] + CATEGORY_CHOICES, coerce=str)
+    percent = DecimalField("Price Change (%)", places=2, validators=[DataRequired(), NumberRange(min=-99.99, max=1000)])
+    submit = SubmitField("Reprice")
+
+
 #Confirm Item Delete Form
 class ConfirmDeleteForm(FlaskForm):
     confirmation = SubmitField("Remove item permanently")
@@ -1,38 +1,263 @@
+import asyncio
+import csv
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
 import os
-from datetime import date
-from xml.dom.minidom import Attr
-from sqlalchemy import Null, Nullable
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+import click
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 import stripe
 from forms import *
 from dotenv import load_dotenv
-from flask import Flask, abort, flash, render_template, redirect, url_for, request, jsonify
+from flask import Flask, Response, abort, before_render_template, flash, g, has_request_context, make_response, render_template, redirect, send_file, session, stream_with_context, template_rendered, url_for, request, jsonify
+from markupsafe import Markup
 from flask_bootstrap import Bootstrap5
-from flask_ckeditor import CKEditor
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user
 from flask_sqlalchemy import SQLAlchemy
-from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy.orm import relationship
+from functools import cached_property, wraps
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import joinedload, relationship, selectinload
+from werkzeug.datastructures import MultiDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image as PILImage, ImageOps, features
+except ImportError:
+    PILImage = None
 
 load_dotenv()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-ckeditor = CKEditor(app)
 Bootstrap5(app)
 
 # Connect to Database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
+def database_uri():
+    uri = os.getenv('DATABASE_URL', 'sqlite:///users.db')
+    # Heroku-style URLs use the scheme SQLAlchemy dropped
+    if uri.startswith("postgres://"):
+        uri = "postgresql://" + uri[len("postgres://"):]
+    return uri
+
+
+def engine_options(uri):
+    options = {'pool_pre_ping': True}
+    if not uri.startswith("sqlite"):
+        options.update(
+            pool_size=int(os.getenv('DB_POOL_SIZE', 10)),
+            max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 20)),
+            pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+            pool_recycle=int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        )
+    return options
+
+
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+app.config['SQLITE_WAL'] = os.getenv('SQLITE_WAL', '1') == '1'
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))
 db = SQLAlchemy()
 db.init_app(app)
 
+
+def configure_sqlite_connection(connection, wal, busy_timeout):
+    cursor = connection.cursor()
+    # busy_timeout makes writers queue instead of failing with "database is locked";
+    # WAL lets readers run alongside the single writer
+    cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+    # Only takes effect on a new database file; lets maintenance return freed pages without a full VACUUM
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute(f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")
+    cursor.execute(f"PRAGMA synchronous={'NORMAL' if wal else 'FULL'}")
+    cursor.close()
+
+
+@event.listens_for(Engine, "connect")
+def on_connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        configure_sqlite_connection(dbapi_connection, app.config['SQLITE_WAL'], app.config['SQLITE_BUSY_TIMEOUT'])
+
+
+def dialect_insert():
+    # INSERT construct that supports ON CONFLICT for the configured database
+    return postgresql.insert if db.engine.dialect.name == "postgresql" else sqlite.insert
+
+
+def sql_greatest(*values):
+    # Multi-argument max() is SQLite's spelling of GREATEST()
+    return (db.func.greatest if db.engine.dialect.name == "postgresql" else db.func.max)(*values)
+
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 
 
+# --- Identity Cache --- #
+# Requests authenticate against a small per-worker TTL/LRU cache of lightweight principals instead of
+# loading the User row (and then its cart) on every request. Entries are dropped when the profile,
+# password or cart changes in this worker; other workers pick changes up within IDENTITY_CACHE_TTL.
+app.config.setdefault('IDENTITY_CACHE_TTL', float(os.getenv('IDENTITY_CACHE_TTL', 60)))
+app.config.setdefault('IDENTITY_CACHE_SIZE', int(os.getenv('IDENTITY_CACHE_SIZE', 1024)))
+
+
+class Principal:
+    __slots__ = ("id", "username", "clearance", "cart_id")
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, username, clearance, cart_id):
+        self.id = id
+        self.username = username
+        self.clearance = clearance
+        self.cart_id = cart_id
+
+    def get_id(self):
+        return str(self.id)
+
+
+class IdentityCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            principal, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return principal
+
+    def put(self, principal):
+        with self._lock:
+            self._entries[principal.id] = (principal, time.monotonic() + app.config['IDENTITY_CACHE_TTL'])
+            self._entries.move_to_end(principal.id)
+            while len(self._entries) > app.config['IDENTITY_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+identities = IdentityCache()
+
+
+# --- Password Hashing --- #
+# Hash settings come from config so cost can be tuned per deployment; hashing runs on a small bounded
+# pool so a burst of logins queues there (or is turned away) instead of pinning every web worker's CPU
+app.config.setdefault('PASSWORD_HASH_METHOD', os.getenv('PASSWORD_HASH_METHOD', 'scrypt'))
+app.config.setdefault('PASSWORD_SALT_LENGTH', int(os.getenv('PASSWORD_SALT_LENGTH', 16)))
+app.config.setdefault('PASSWORD_HASH_WORKERS', int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 2)))
+app.config.setdefault('PASSWORD_HASH_QUEUE', int(os.getenv('PASSWORD_HASH_QUEUE', 64)))
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, method, salt_length, workers, queue_size):
+        self.method = method
+        self.salt_length = salt_length
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def _run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            return self.pool.submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    @cached_property
+    def prefix(self):
+        # Werkzeug expands defaults (e.g. "scrypt" -> "scrypt:32768:8:1"); compare stored hashes against the expanded form.
+        # Worked out on first use because it costs a full hash, which would otherwise land on every worker boot
+        return generate_password_hash("", method=self.method, salt_length=self.salt_length).split("$")[0]
+
+    def needs_rehash(self, password_hash):
+        method, _, rest = password_hash.partition("$")
+        salt = rest.partition("$")[0]
+        return method != self.prefix or len(salt) != self.salt_length
+
+
+hasher = PasswordHasher(
+    app.config['PASSWORD_HASH_METHOD'],
+    app.config['PASSWORD_SALT_LENGTH'],
+    app.config['PASSWORD_HASH_WORKERS'],
+    app.config['PASSWORD_HASH_QUEUE'],
+)
+
+
+@app.cli.command("bench-hashes")
+@click.option("--method", "methods", multiple=True, help="Werkzeug hash method to time; repeatable.")
+@click.option("--seconds", default=2.0, help="Time spent per method.")
+def bench_hashes(methods, seconds):
+    """Report password hashes/sec for candidate hash settings."""
+    methods = methods or [app.config['PASSWORD_HASH_METHOD'], "scrypt:16384:8:1", "pbkdf2:sha256:600000", "pbkdf2:sha256:260000"]
+    for method in methods:
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            generate_password_hash("benchmark-password", method=method, salt_length=app.config['PASSWORD_SALT_LENGTH'])
+            count += 1
+        click.echo(f"{method}: {count / (time.perf_counter() - start):.1f} hashes/sec per core")
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return db.get_or_404(User, user_id)
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return None
+
+    principal = identities.get(user_id)
+    if principal is None:
+        # One round trip for the user and their cart id
+        row = db.session.execute(
+            db.select(User.id, User.username, User.clearance, Cart.id)
+            .outerjoin(Cart, Cart.user_id == User.id)
+            .where(User.id == user_id)
+        ).first()
+        if row is None:
+            return None
+        principal = Principal(*row)
+        identities.put(principal)
+    return principal
 
 
 def admin_only(f):
@@ -44,18 +269,310 @@ def admin_only(f):
     return wrapper
 
 
+# --- SQL Query Budget --- #
+# Counts and times statements per request; with ENFORCE_QUERY_BUDGET set (e.g. under test), views decorated
+# with query_budget fail loudly if they issue more statements than their fixed budget
+app.config.setdefault('ENFORCE_QUERY_BUDGET', os.getenv('ENFORCE_QUERY_BUDGET') == '1')
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def time_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    if not has_request_context():
+        return
+    g.query_time = g.get('query_time', 0.0) + elapsed
+    if 'queries' in g and len(g.queries) < 200:
+        g.queries.append((elapsed, statement))
+
+
+@event.listens_for(Engine, "handle_error")
+def discard_query_timer(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+
+def check_query_budget(f, start, limit):
+    used = g.get('query_count', 0) - start
+    if app.config['ENFORCE_QUERY_BUDGET'] and used > limit:
+        raise AssertionError(f"{f.__name__} issued {used} SQL statements (budget {limit})")
+
+
+def query_budget(limit):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = g.get('query_count', 0)
+            response = f(*args, **kwargs)
+            check_query_budget(f, start, limit)
+            return response
+        return wrapper
+    return decorator
+
+
+# --- Instrumentation --- #
+# Per-worker Prometheus metrics: request latency per endpoint, plus how much of each request went to
+# SQL, template rendering and Stripe. With SLOW_REQUEST_MS set, slower requests are logged together
+# with the statements they ran. /metrics requires `Authorization: Bearer <METRICS_TOKEN>`; with no token
+# configured it only answers requests from localhost (behind a local reverse proxy, set a token).
+app.config.setdefault('SLOW_REQUEST_MS', float(os.getenv('SLOW_REQUEST_MS', 0)))
+app.config.setdefault('METRICS_TOKEN', os.getenv('METRICS_TOKEN'))
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            counts = self.series.setdefault(label_values, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            series = {key: list(counts) for key, counts in self.series.items()}
+        for key, counts in sorted(series.items()):
+            labels = dict(zip(self.labels, key))
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", {**labels, "le": repr(float(bound))}, count
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, counts[-2]
+            yield f"{self.name}_count", labels, counts[-2]
+            yield f"{self.name}_sum", labels, counts[-1]
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            series = dict(self.series)
+        for key, value in sorted(series.items()):
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render_metrics(metrics):
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            label_text = ",".join(f'{key}="{escape_label(val)}"' for key, val in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Time spent handling a request.", ("endpoint", "method"))
+REQUESTS = Counter("http_requests_total", "Requests handled, by response status.", ("endpoint", "method", "status"))
+REQUEST_SQL_STATEMENTS = Histogram("http_request_sql_statements", "SQL statements issued per request.", ("endpoint",), COUNT_BUCKETS)
+REQUEST_SQL_TIME = Histogram("http_request_sql_seconds", "Time spent in SQL per request.", ("endpoint",))
+REQUEST_TEMPLATE_TIME = Histogram("http_request_template_seconds", "Time spent rendering templates per request.", ("endpoint",))
+STRIPE_LATENCY = Histogram("stripe_request_duration_seconds", "Latency of Stripe API calls.", ("operation",))
+STRIPE_ERRORS = Counter("stripe_request_errors_total", "Stripe API calls that raised.", ("operation",))
+METRICS = [REQUEST_LATENCY, REQUESTS, REQUEST_SQL_STATEMENTS, REQUEST_SQL_TIME, REQUEST_TEMPLATE_TIME,
+           STRIPE_LATENCY, STRIPE_ERRORS]
+
+
+def endpoint_label():
+    # Unmatched URLs share one label so 404 scans can't blow up the series count
+    return request.endpoint or "unmatched"
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if app.config['SLOW_REQUEST_MS']:
+        g.queries = []
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = endpoint_label()
+    REQUEST_LATENCY.observe(elapsed, endpoint, request.method)
+    REQUESTS.inc(endpoint, request.method, response.status_code)
+    REQUEST_SQL_STATEMENTS.observe(g.get('query_count', 0), endpoint)
+    REQUEST_SQL_TIME.observe(g.get('query_time', 0.0), endpoint)
+    REQUEST_TEMPLATE_TIME.observe(g.get('template_time', 0.0), endpoint)
+
+    slow_ms = app.config['SLOW_REQUEST_MS']
+    if slow_ms and elapsed * 1000 >= slow_ms:
+        queries = "".join(f"\n  {ms * 1000:8.2f} ms  {' '.join(sql.split())}" for ms, sql in g.get('queries', []))
+        app.logger.warning(
+            "Slow request %s %s -> %s: %.1f ms (sql %d stmts / %.1f ms, templates %.1f ms, stripe %.1f ms)%s",
+            request.method, request.full_path.rstrip("?"), response.status_code, elapsed * 1000,
+            g.get('query_count', 0), g.get('query_time', 0.0) * 1000, g.get('template_time', 0.0) * 1000,
+            g.get('stripe_time', 0.0) * 1000, queries,
+        )
+    return response
+
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    g.setdefault('template_started', []).append(time.perf_counter())
+
+
+@template_rendered.connect_via(app)
+def record_template_time(sender, template, context, **extra):
+    started = g.get('template_started')
+    if started:
+        g.template_time = g.get('template_time', 0.0) + time.perf_counter() - started.pop()
+
+
+def observe_stripe_call(operation, started, failed):
+    elapsed = time.perf_counter() - started
+    STRIPE_LATENCY.observe(elapsed, operation)
+    if failed:
+        STRIPE_ERRORS.inc(operation)
+    if has_request_context():
+        g.stripe_time = g.get('stripe_time', 0.0) + elapsed
+
+
+class StripeBusy(stripe.error.StripeError):
+    pass
+
+
+class StripeTimer:
+    """Proxy over the stripe module that times every API call, e.g. ``stripe_api.checkout.Session.create``.
+    With `slots`, a call first waits up to STRIPE_TIMEOUT for one of them and raises StripeBusy if none frees up."""
+
+    def __init__(self, target, path, slots=None):
+        self._target = target
+        self._path = path
+        self._slots = slots
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        path = f"{self._path}.{name}"
+        if isinstance(attr, (type, type(stripe))):
+            return StripeTimer(attr, path, self._slots)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            failed = True
+            try:
+                if self._slots is None:
+                    result = attr(*args, **kwargs)
+                elif self._slots.acquire(timeout=app.config['STRIPE_TIMEOUT']):
+                    try:
+                        result = attr(*args, **kwargs)
+                    finally:
+                        self._slots.release()
+                else:
+                    raise StripeBusy(f"No free Stripe slot for {path}")
+                failed = False
+                return result
+            finally:
+                observe_stripe_call(path, started, failed)
+        return timed
+
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if request.headers.get('Authorization') != f"Bearer {token}":
+            abort(401)
+    elif request.remote_addr not in ("127.0.0.1", "::1"):
+        abort(403)
+    return Response(render_metrics(METRICS), mimetype="text/plain; version=0.0.4")
+
+
 # Set up Stripe Checkout session
+# Every call times out after STRIPE_TIMEOUT, and at most STRIPE_MAX_CONCURRENCY are in flight per worker,
+# so a slow Stripe can tie up only that many request threads; the rest fail fast with StripeBusy
+app.config.setdefault('STRIPE_TIMEOUT', float(os.getenv('STRIPE_TIMEOUT', 10)))
+app.config.setdefault('STRIPE_MAX_CONCURRENCY', int(os.getenv('STRIPE_MAX_CONCURRENCY', 32)))
+# Points the Stripe SDK at another API host (e.g. a local fake for benchmarks)
+app.config.setdefault('STRIPE_API_BASE', os.getenv('STRIPE_API_BASE'))
 stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+stripe.default_http_client = stripe.RequestsClient(timeout=app.config['STRIPE_TIMEOUT'])
+if app.config['STRIPE_API_BASE']:
+    stripe.api_base = app.config['STRIPE_API_BASE']
+stripe_api = StripeTimer(stripe, "stripe", threading.BoundedSemaphore(app.config['STRIPE_MAX_CONCURRENCY']))
 YOUR_DOMAIN = os.getenv('DOMAIN')
 
 
+def shipping_options():
+    # Shipping rates registered in the Stripe dashboard are referenced by id; otherwise send the inline rates
+    rate_ids = [rate_id.strip() for rate_id in os.getenv('STRIPE_SHIPPING_RATES', '').split(',') if rate_id.strip()]
+    if rate_ids:
+        return [{"shipping_rate": rate_id} for rate_id in rate_ids]
+
+    rates = [
+        # (amount in cents, display name, min business days, max business days)
+        (0, "Free shipping", 5, 7),
+        (500, "Two-day shipping", 2, 2),
+        (1500, "Next day air", 1, 1),
+    ]
+    return [
+        {
+            "shipping_rate_data": {
+                "type": "fixed_amount",
+                "fixed_amount": {"amount": amount, "currency": "usd"},
+                "display_name": name,
+                "delivery_estimate": {
+                    "minimum": {"unit": "business_day", "value": minimum},
+                    "maximum": {"unit": "business_day", "value": maximum},
+                },
+            },
+        }
+        for amount, name, minimum, maximum in rates
+    ]
+
+
+# Built once at startup instead of on every checkout
+SHIPPING_OPTIONS = shipping_options()
+
+
 # User Config
 class User(UserMixin, db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(250), unique=True, nullable=False)
     email = db.Column(db.String(250), unique=True, nullable=False)
-    password = db.Column(db.String(50), unique=False, nullable=False)
+    password = db.Column(db.String(255), unique=False, nullable=False)
     clearance = db.Column(db.Boolean, unique=False, nullable=False)
     shipping_address = db.Column(db.String, nullable=True)
     billing_address = db.Column(db.String, nullable=True)
@@ -70,7 +587,7 @@ class Item(db.Model):
     stripe_prod_id = db.Column(db.String, unique=True, nullable=False)
     stripe_price_id = db.Column(db.String, unique=True, nullable=False)
     name = db.Column(db.String(250), unique=True, nullable=False)
-    category = db.Column(db.String, unique=False, nullable=False)
+    category = db.Column(db.String, unique=False, nullable=False, index=True)
     price = db.Column(db.Float, unique=False, nullable=False)
     unit = db.Column(db.String, unique=False, nullable=False)
     unit_amt = db.Column(db.Float, unique=False, nullable=False)
@@ -90,6 +607,13 @@ class OrderItem(UserMixin, db.Model):
     parent_order = relationship("Order", back_populates="items")
     parent_cart = relationship("Cart", back_populates="items")
     quantity = db.Column(db.Integer, unique=False, nullable=False)
+    # Unit price in cents when the order was placed, so reports don't depend on today's prices
+    price = db.Column(db.Float, nullable=True)
+    # One row per item per cart, so quantity changes can be a single upsert
+    __table_args__ = (
+        db.Index("ix_ordered_items_cart_item", "cart_id", "item_id", unique=True),
+        db.Index("ix_ordered_items_order_id", "order_id"),
+    )
 
 
 # Order Config
@@ -99,9 +623,18 @@ class Order(UserMixin, db.Model):
     __tablename__ = "orders"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    # Legacy "%m/%d/%Y" string; migrate_order_dates() copies it into created_at
     date = db.Column(db.String(250))
+    created_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    stripe_session_id = db.Column(db.String, nullable=True)
     customer = relationship("User", back_populates="orders")
     items = relationship("OrderItem", back_populates="parent_order")
+    __table_args__ = (
+        # One order per Checkout Session, so replayed webhooks can't create duplicates
+        db.Index("ix_orders_stripe_session_id", "stripe_session_id", unique=True),
+        db.Index("ix_orders_user_created", "user_id", "created_at"),
+        db.Index("ix_orders_created_at", "created_at"),
+    )
     # shipping_address = db.Column(db.String, nullable=True)
     # billing_address = db.Column(db.String, nullable=True)
     
@@ -109,22 +642,1112 @@ class Order(UserMixin, db.Model):
 class Cart(UserMixin, db.Model):
     __tablename__ = "carts"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), unique=True, index=True)
     customer = relationship("User", back_populates="cart")
     items = relationship("OrderItem", back_populates="parent_cart")
+    # Last Checkout Session created for this cart, reused while the cart contents are unchanged
+    checkout_session_id = db.Column(db.String, nullable=True)
+    checkout_url = db.Column(db.String, nullable=True)
+    checkout_fingerprint = db.Column(db.String(64), nullable=True)
+    checkout_expires_at = db.Column(db.Float, nullable=True)
+    # Running totals over the cart's lines, refreshed on every cart or price write (see refresh_cart_totals)
+    # so the header badge and cart page never walk the lines
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    subtotal_cents = db.Column(db.Integer, nullable=False, default=0)
+    # Last time the customer changed the cart; idle carts are collected after CART_TTL_DAYS
+    updated_at = db.Column(db.Float, nullable=True)
+
+
+# Catalog Version Config
+# Single-row counter shared by every worker process; bumped on every catalog write
+class CatalogVersion(db.Model):
+    __tablename__ = "catalog-version"
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, unique=False, nullable=False, default=0)
+
+
+# Stripe Outbox Config
+# One row per pending push of local Item changes to Stripe, drained by the sync worker
+class StripeSyncTask(db.Model):
+    __tablename__ = "stripe-outbox"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    item_id = db.Column(db.Integer, nullable=False, index=True)
+    stripe_prod_id = db.Column(db.String, nullable=False)
+    action = db.Column(db.String(20), nullable=False)
+    price_changed = db.Column(db.Boolean, nullable=False, default=False)
+    # False when only the price changed, so the Product itself needn't be rewritten (NULL on older rows means True)
+    product_changed = db.Column(db.Boolean, nullable=True, default=True)
+    status = db.Column(db.String(20), nullable=False, default="pending", index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.Float, nullable=False, default=0.0)
+    last_error = db.Column(db.String, nullable=True)
+    updated_at = db.Column(db.Float, nullable=False, default=time.time)
+
+
+# Stock Reservation Config
+# Stock held for a cart between checkout and payment; released on cancel or expiry
+class StockReservation(db.Model):
+    __tablename__ = "stock-reservations"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    cart_id = db.Column(db.Integer, nullable=False, index=True)
+    item_id = db.Column(db.Integer, db.ForeignKey("items.id", ondelete="CASCADE"), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="held")
+    expires_at = db.Column(db.Float, nullable=False)
+    # Checkout Session the hold was taken for, so a session paid after its hold was released can retake it
+    checkout_session_id = db.Column(db.String, nullable=True, index=True)
+    __table_args__ = (db.Index("ix_stock_reservations_status_expires", "status", "expires_at"),)
 
 
 # --- Initialize db for first time --- #
-with app.app_context():
+# Schema creation and data backfills run from `flask init-db` (part of a deploy) rather than on import,
+# so booting a worker or a test process never touches the database. Each section registers its own step.
+SETUP_STEPS = []
+
+
+def setup_step(f):
+    SETUP_STEPS.append(f)
+    return f
+
+
+def init_db():
+    """Create or upgrade the schema and run every backfill. Safe to run repeatedly."""
+    for step in SETUP_STEPS:
+        step()
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create missing tables, columns and indexes, then run pending data backfills."""
+    for step in SETUP_STEPS:
+        start = time.perf_counter()
+        step()
+        click.echo(f"{step.__name__}: {time.perf_counter() - start:.2f}s")
+
+
+def add_missing_columns():
+    # create_all never alters existing tables, so add columns introduced after a table was created
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    connection.execute(db.text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+
+
+@setup_step
+def create_schema():
     db.create_all()
+    add_missing_columns()
+    # create_all skips indexes on tables that already exist
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    if not db.session.get(CatalogVersion, 1):
+        db.session.add(CatalogVersion(id=1, version=0))
+        db.session.commit()
+
+
+@setup_step
+def migrate_order_dates(batch_size=1000):
+    """Fill Order.created_at from the legacy date strings. Returns the number of orders migrated."""
+    migrated = 0
+    while True:
+        # Orders without a legacy date get the epoch too, so every order has a created_at to page on
+        rows = db.session.execute(
+            db.select(Order.id, Order.date).where(Order.created_at.is_(None)).limit(batch_size)
+        ).all()
+        if not rows:
+            return migrated
+        updates = []
+        for order_id, legacy_date in rows:
+            try:
+                created_at = datetime.strptime(legacy_date, "%m/%d/%Y").replace(tzinfo=timezone.utc)
+            except (TypeError, ValueError):
+                created_at = datetime(1970, 1, 1, tzinfo=timezone.utc)
+            updates.append({"order_id": order_id, "created_at": created_at})
+        db.session.execute(
+            db.update(Order.__table__).where(Order.__table__.c.id == db.bindparam("order_id")).values(created_at=db.bindparam("created_at")),
+            updates,
+        )
+        db.session.commit()
+        migrated += len(rows)
+
+
+@app.cli.command("migrate-order-dates")
+def migrate_order_dates_command():
+    """Convert legacy order date strings into indexed timestamps."""
+    click.echo(f"Migrated {migrate_order_dates()} order(s)")
+
+
+#--- Catalog Cache ---#
+# Immutable, session-independent copy of an Item row for rendering catalog pages
+ItemSnapshot = namedtuple("ItemSnapshot", [column.name for column in Item.__table__.columns])
+
+# Seconds a worker trusts its cached catalog before re-checking the shared version counter
+app.config.setdefault('CATALOG_CACHE_CHECK_INTERVAL', float(os.getenv('CATALOG_CACHE_CHECK_INTERVAL', 1.0)))
+
+
+class CatalogCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._items = ()
+        self._checked_at = 0.0
+
+    def _shared_version(self):
+        return db.session.execute(db.select(CatalogVersion.version).where(CatalogVersion.id == 1)).scalar() or 0
+
+    def items(self):
+        # Serve from memory while the last version check is fresh
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < app.config['CATALOG_CACHE_CHECK_INTERVAL']:
+            return self._items
+
+        with self._lock:
+            version = self._shared_version()
+            if version != self._version:
+                db_items = db.session.execute(db.select(Item).order_by('id')).scalars()
+                self._items = tuple(ItemSnapshot(*[getattr(item, name) for name in ItemSnapshot._fields]) for item in db_items)
+                self._version = version
+            self._checked_at = now
+            return self._items
+
+    def version(self):
+        self.items()
+        return self._version
+
+    def invalidate(self):
+        # Bump the shared counter inside the caller's transaction so every worker reloads after commit
+        db.session.execute(db.update(CatalogVersion).where(CatalogVersion.id == 1).values(version=CatalogVersion.version + 1))
+        with self._lock:
+            self._version = None
+
+
+catalog = CatalogCache()
+
+
+#--- HTTP Caching ---#
+# Catalog pages carry ETags built from the catalog version (item pages from the row itself), so repeat
+# visitors and proxies get a 304 without a render. Anonymous pages are shared-cacheable; logged-in
+# pages show the user's name and cart, so they're private and always revalidated.
+app.config.setdefault('PUBLIC_PAGE_MAX_AGE', int(os.getenv('PUBLIC_PAGE_MAX_AGE', 60)))
+app.config.setdefault('FRAGMENT_CACHE_SIZE', int(os.getenv('FRAGMENT_CACHE_SIZE', 256)))
+
+
+def viewer_key():
+    if current_user.is_authenticated:
+        # The header shows the user's name and cart badge
+        return f"user-{current_user.id}-{current_user.username}-{cart_summary()}"
+    return "anonymous"
+
+
+def make_etag(*parts):
+    return hashlib.sha1("|".join(str(part) for part in (asset_version,) + parts).encode()).hexdigest()
+
+
+def cached_page(etag, render):
+    """Answer with 304 if the client already has this version of the page, otherwise render it."""
+    if session.get('_flashes'):
+        # A pending flash message is part of this one response only: render it and keep it out of caches
+        response = make_response(render())
+        response.cache_control.no_store = True
+        return response
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['PUBLIC_PAGE_MAX_AGE']
+    response.vary.add("Cookie")
+    return response
+
+
+class FragmentCache:
+    # Rendered HTML keyed by catalog version and render inputs; entries for old versions age out
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                return html
+        html = Markup(render())
+        with self._lock:
+            self._entries[key] = html
+            while len(self._entries) > app.config['FRAGMENT_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+        return html
+
+
+fragments = FragmentCache()
+
+
+def item_grid(version, items, *key):
+    # Admins see edit/delete buttons, so they get their own copy of the grid
+    is_admin = current_user.is_authenticated and current_user.id == 1
+    return fragments.get_or_render(
+        ("item-grid", version, is_admin) + key,
+        lambda: render_template("item_grid.html", items=items),
+    )
+
+CATEGORIES = dict(CATEGORY_CHOICES)
+
+
+#--- Stripe Catalog Sync ---#
+# Admin writes only touch the local db and queue a StripeSyncTask; a background worker pushes
+# the latest Item state to Stripe, coalescing repeated edits and retrying failures with backoff
+PENDING_STRIPE_PREFIX = "pending:"
+app.config.setdefault('STRIPE_SYNC_INTERVAL', float(os.getenv('STRIPE_SYNC_INTERVAL', 2.0)))
+app.config.setdefault('STRIPE_SYNC_BATCH_SIZE', int(os.getenv('STRIPE_SYNC_BATCH_SIZE', 50)))
+app.config.setdefault('STRIPE_SYNC_MAX_ATTEMPTS', int(os.getenv('STRIPE_SYNC_MAX_ATTEMPTS', 8)))
+app.config.setdefault('STRIPE_SYNC_BACKOFF', float(os.getenv('STRIPE_SYNC_BACKOFF', 2.0)))
+app.config.setdefault('STRIPE_SYNC_CONCURRENCY', int(os.getenv('STRIPE_SYNC_CONCURRENCY', 8)))
+# Seconds a claimed task may stay "processing" before it's treated as abandoned (worker crash or deploy) and retried
+app.config.setdefault('STRIPE_SYNC_LEASE', float(os.getenv('STRIPE_SYNC_LEASE', 600)))
+
+
+def pending_stripe_id():
+    # Unique placeholder until the worker learns the real Stripe id
+    return PENDING_STRIPE_PREFIX + uuid.uuid4().hex
+
+
+def is_pending_stripe_id(stripe_id):
+    return stripe_id.startswith(PENDING_STRIPE_PREFIX)
+
+
+def enqueue_stripe_sync(item, action, price_changed=False, product_changed=True):
+    # Fold into a queued task for the same item instead of pushing every intermediate edit. The fold is a single
+    # conditional UPDATE, so a task the worker claims in the meantime is left alone and a fresh one is queued
+    values = dict(action=action, stripe_prod_id=item.stripe_prod_id, updated_at=time.time())
+    if price_changed:
+        values["price_changed"] = True
+    if product_changed:
+        values["product_changed"] = True
+    folded = db.session.execute(
+        db.update(StripeSyncTask)
+        .where(StripeSyncTask.item_id == item.id, StripeSyncTask.status == "pending")
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not folded:
+        db.session.add(StripeSyncTask(item_id=item.id, stripe_prod_id=item.stripe_prod_id, action=action,
+                                      price_changed=price_changed, product_changed=product_changed))
+
+
+def enqueue_stripe_syncs(prod_ids, price_changed_ids, product_changed=True):
+    """Queue "upsert" tasks for {item_id: stripe_prod_id} in a few statements, folding into pending tasks."""
+    values = dict(updated_at=time.time())
+    if price_changed_ids:
+        values["price_changed"] = db.case(
+            (StripeSyncTask.item_id.in_(price_changed_ids), True), else_=StripeSyncTask.price_changed
+        )
+    if product_changed:
+        values["product_changed"] = True
+    # RETURNING reports the tasks actually folded into, so one claimed since the caller looked still gets a new task
+    folded = set(db.session.execute(
+        db.update(StripeSyncTask)
+        .where(StripeSyncTask.item_id.in_(prod_ids), StripeSyncTask.status == "pending")
+        .values(**values)
+        .returning(StripeSyncTask.item_id)
+        .execution_options(synchronize_session=False)
+    ).scalars()) if prod_ids else set()
+    new_tasks = [
+        dict(item_id=item_id, stripe_prod_id=prod_id, action="upsert", price_changed=item_id in price_changed_ids,
+             product_changed=product_changed, status="pending", attempts=0, next_attempt_at=0.0, updated_at=time.time())
+        for item_id, prod_id in prod_ids.items() if item_id not in folded
+    ]
+    if new_tasks:
+        db.session.execute(db.insert(StripeSyncTask), new_tasks)
+
+
+def push_item_to_stripe(client, task):
+    if task.action == "deactivate":
+        if not is_pending_stripe_id(task.stripe_prod_id):
+            client.Product.modify(task.stripe_prod_id, active=False)
+        return
+
+    item = db.session.get(Item, task.item_id)
+    if item is None:
+        return
+
+    product = dict(
+        name=item.name,
+        description=item.description,
+        metadata={
+            'category': item.category,
+            'unit': item.unit,
+            'unit_amt': item.unit_amt,
+            'stock': item.stock
+            },
+        images=[item.img_url],
+    )
+    # Idempotency keys make a retried task get back the objects an earlier, failed attempt already created
+    if is_pending_stripe_id(item.stripe_prod_id):
+        item.stripe_prod_id = client.Product.create(**product, idempotency_key=f"stripe-sync-{task.id}-product").id
+        # Keep the new product even if a later call fails and the attempt is rolled back
+        db.session.commit()
+    elif task.product_changed is not False:
+        client.Product.modify(item.stripe_prod_id, **product)
+
+    if task.price_changed or is_pending_stripe_id(item.stripe_price_id):
+        # Create the new Price before retiring the old one so the item always has an active Price
+        old_price_id = item.stripe_price_id
+        new_price = client.Price.create(
+            product=item.stripe_prod_id,
+            currency="usd",
+            unit_amount=int(item.price),
+            nickname=item.name,
+            idempotency_key=f"stripe-sync-{task.id}-price-{int(item.price)}",
+        )
+        item.stripe_price_id = new_price.id
+        if not is_pending_stripe_id(old_price_id):
+            client.Price.modify(old_price_id, active=False)
+
+
+def sync_stripe_task(client, task_id):
+    """Push one claimed task to Stripe and record the outcome. Returns True on success."""
+    task = db.session.get(StripeSyncTask, task_id)
+    try:
+        push_item_to_stripe(client, task)
+    except Exception as e:
+        db.session.rollback()
+        task = db.session.get(StripeSyncTask, task_id)
+        task.attempts += 1
+        task.last_error = str(e)
+        if task.attempts >= app.config['STRIPE_SYNC_MAX_ATTEMPTS']:
+            task.status = "failed"
+        else:
+            task.status = "pending"
+            task.next_attempt_at = time.time() + app.config['STRIPE_SYNC_BACKOFF'] ** task.attempts
+        synced = False
+    else:
+        task.status = "done"
+        task.last_error = None
+        synced = True
+    task.updated_at = time.time()
+    db.session.commit()
+    return synced
+
+
+def stalled_tasks(now):
+    # Claimed by a worker that never reported back within the lease
+    return db.and_(StripeSyncTask.status == "processing", StripeSyncTask.updated_at < now - app.config['STRIPE_SYNC_LEASE'])
+
+
+def claimable_tasks(now):
+    return db.or_(db.and_(StripeSyncTask.status == "pending", StripeSyncTask.next_attempt_at <= now), stalled_tasks(now))
+
+
+def process_stripe_outbox(client=stripe_api, limit=None, concurrency=None):
+    """Push due outbox tasks to Stripe, up to `concurrency` at once. Returns the number of tasks attempted."""
+    limit = limit or app.config['STRIPE_SYNC_BATCH_SIZE']
+    concurrency = concurrency or app.config['STRIPE_SYNC_CONCURRENCY']
+    claimable = claimable_tasks(time.time())
+    task_ids = db.session.execute(
+        db.select(StripeSyncTask.id).where(claimable).order_by(StripeSyncTask.id).limit(limit)
+    ).scalars().all()
+    if not task_ids:
+        return 0
+
+    # Claim the batch so a worker in another process can't push the same tasks twice
+    claimed = db.session.execute(
+        db.update(StripeSyncTask)
+        .where(StripeSyncTask.id.in_(task_ids), claimable)
+        .values(status="processing", updated_at=time.time())
+        .returning(StripeSyncTask.id)
+    ).scalars().all()
+    db.session.commit()
+
+    if concurrency <= 1 or len(claimed) <= 1:
+        synced = [sync_stripe_task(client, task_id) for task_id in claimed]
+    else:
+        # Each thread gets its own app context and therefore its own session
+        def sync_in_context(task_id):
+            with app.app_context():
+                try:
+                    return sync_stripe_task(client, task_id)
+                finally:
+                    db.session.remove()
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="stripe-sync") as pool:
+            synced = list(pool.map(sync_in_context, claimed))
+
+    if any(synced):
+        catalog.invalidate()
+        db.session.commit()
+    return len(claimed)
+
+
+class StripeSyncWorker(threading.Thread):
+    def __init__(self, client=stripe_api, interval=None):
+        super().__init__(name="stripe-sync", daemon=True)
+        self.client = client
+        self.interval = interval or app.config['STRIPE_SYNC_INTERVAL']
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            with app.app_context():
+                try:
+                    # Keep draining while full batches come back
+                    while process_stripe_outbox(self.client) >= app.config['STRIPE_SYNC_BATCH_SIZE']:
+                        pass
+                except Exception as e:
+                    app.logger.exception("Stripe sync failed: %s", e)
+                finally:
+                    db.session.remove()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+@app.cli.command("stripe-sync")
+@click.option("--once", is_flag=True, help="Drain due tasks once and exit.")
+def stripe_sync(once):
+    """Push queued catalog changes to Stripe."""
+    if once:
+        click.echo(f"Processed {process_stripe_outbox()} task(s)")
+        return
+    worker = StripeSyncWorker()
+    worker.start()
+    worker.join()
+
+
+#--- Product Search ---#
+# FTS5 index over items, kept in sync with the items table by triggers so every write path
+# (admin forms, bulk loads, raw SQL) updates it in the same transaction
+SEARCH_INDEX_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+        name, description, category,
+        content='items', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3 4'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+        INSERT INTO items_fts(rowid, name, description, category) VALUES (new.id, new.name, new.description, new.category);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, name, description, category) VALUES ('delete', old.id, old.name, old.description, old.category);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF name, description, category ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, name, description, category) VALUES ('delete', old.id, old.name, old.description, old.category);
+        INSERT INTO items_fts(rowid, name, description, category) VALUES (new.id, new.name, new.description, new.category);
+    END""",
+]
+app.config.setdefault('SEARCH_RESULT_LIMIT', int(os.getenv('SEARCH_RESULT_LIMIT', 50)))
+
+
+def fts_available():
+    return db.engine.dialect.name == "sqlite"
+
+
+def create_search_index(connection):
+    for statement in SEARCH_INDEX_DDL:
+        connection.exec_driver_sql(statement)
+    # Backfill rows written before the index existed
+    connection.exec_driver_sql("INSERT INTO items_fts(items_fts) VALUES ('rebuild')")
+
+
+def fts_query(text):
+    # Quote each term and prefix-match it so user input can't inject FTS5 query syntax
+    terms = re.findall(r"\w+", text)
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def search_items(text, limit):
+    match = fts_query(text)
+    if not match:
+        return []
+
+    if fts_available():
+        ids = db.session.execute(
+            db.text("SELECT rowid FROM items_fts WHERE items_fts MATCH :match ORDER BY rank LIMIT :limit"),
+            {"match": match, "limit": limit},
+        ).scalars().all()
+        items = {item.id: item for item in db.session.execute(db.select(Item).where(Item.id.in_(ids))).scalars()}
+        return [items[item_id] for item_id in ids if item_id in items]
+
+    # Other databases: plain substring scan
+    pattern = f"%{text.strip()}%"
+    return db.session.execute(
+        db.select(Item)
+        .where(db.or_(Item.name.ilike(pattern), Item.description.ilike(pattern), Item.category.ilike(pattern)))
+        .order_by(Item.id)
+        .limit(limit)
+    ).scalars().all()
+
+
+@setup_step
+def build_search_index():
+    if fts_available():
+        with db.engine.begin() as connection:
+            create_search_index(connection)
+
+
+@app.route("/search")
+def search():
+    query = request.args.get('q', '').strip()
+    items = search_items(query, app.config['SEARCH_RESULT_LIMIT']) if query else []
+    return render_template("search.html", logged_in=current_user.is_authenticated, items=items, query=query)
+
+
+@app.cli.command("bench-search")
+@click.option("--rows", default=100000, help="Number of synthetic items to index.")
+@click.option("--queries", default=200, help="Number of queries to time per strategy.")
+def bench_search(rows, queries):
+    """Compare FTS5 search against a naive LIKE scan on a synthetic catalog."""
+    # Synthetic vocabulary large enough that a term matches a realistic slice of the catalog
+    syllables = ["ma", "ple", "ha", "ba", "ne", "ro", "chi", "po", "tle", "ber", "ry", "fig", "gin", "ger", "lo", "mi"]
+    words = [a + b + c for a in syllables for b in syllables for c in syllables]
+    categories = list(CATEGORIES)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        connection = sqlite3.connect(os.path.join(tmp, "bench.db"))
+        connection.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT, description TEXT, category TEXT)")
+        for statement in SEARCH_INDEX_DDL:
+            connection.execute(statement)
+        connection.executemany(
+            "INSERT INTO items (id, name, description, category) VALUES (?, ?, ?, ?)",
+            ((i, f"{words[i % len(words)]} {words[(i * 7) % len(words)]}", f"{words[(i * 13) % len(words)]} small batch",
+              categories[i % len(categories)]) for i in range(1, rows + 1)),
+        )
+        connection.commit()
+
+        terms = [words[(i * 31) % len(words)] for i in range(queries)]
+        strategies = {
+            "fts5": lambda term: connection.execute(
+                "SELECT rowid FROM items_fts WHERE items_fts MATCH ? ORDER BY rank LIMIT 50", (fts_query(term),)).fetchall(),
+            "like": lambda term: connection.execute(
+                "SELECT id FROM items WHERE name LIKE ? OR description LIKE ? OR category LIKE ?",
+                (f"%{term}%",) * 3).fetchall(),
+        }
+        for name, run in strategies.items():
+            start = time.perf_counter()
+            for term in terms:
+                run(term)
+            elapsed = time.perf_counter() - start
+            click.echo(f"{name}: {rows} rows, {queries} queries, {elapsed / queries * 1000:.3f} ms/query")
+        connection.close()
+
+
+
+#--- Bulk Catalog Import/Export ---#
+# Columns shared by import and export files, so an export can be loaded back unchanged
+CATALOG_FIELDS = ["name", "category", "price", "unit", "unit_amt", "img_url", "description", "stock"]
+app.config.setdefault('CATALOG_IMPORT_BATCH_SIZE', int(os.getenv('CATALOG_IMPORT_BATCH_SIZE', 1000)))
+
+
+def read_catalog_rows(stream, file_format):
+    """Yield (line number, row) for each record of a binary upload, or (line number, message) for a line that can't
+    be read, so one bad line is reported with the other rejects instead of aborting the import."""
+    unreadable = []
+
+    def lines():
+        for line_number, line in enumerate(stream, start=1):
+            try:
+                yield line.decode("utf-8-sig" if line_number == 1 else "utf-8")
+            except UnicodeDecodeError as e:
+                unreadable.append((line_number, f"Not valid UTF-8: {e.reason}"))
+                yield "\n"
+
+    def drain_unreadable():
+        drained = unreadable[:]
+        unreadable.clear()
+        return drained
+
+    if file_format == "csv":
+        reader = csv.DictReader(lines())
+        for row in reader:
+            yield from drain_unreadable()
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(lines(), start=1):
+            yield from drain_unreadable()
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, f"Invalid JSON: {e}"
+                continue
+            yield line_number, row if isinstance(row, dict) else "Expected a JSON object"
+    yield from drain_unreadable()
+
+
+def validate_catalog_row(form, row):
+    # Reuse the admin form's field rules so bulk rows obey the same constraints as add_item;
+    # one bound form is re-processed per row because building a form dominates the cost
+    row = {key: str(value) for key, value in row.items() if value is not None}
+    # Exports written before prices were saved as whole cents say e.g. "275.0"
+    if re.fullmatch(r"\d+\.0*", row.get("price", "")):
+        row["price"] = row["price"].split(".")[0]
+    form.process(MultiDict(row))
+    if not form.validate():
+        return None, {field: errors[0] for field, errors in form.errors.items()}
+    return dict(
+        name=form.name.data,
+        category=form.category.data,
+        price=form.price.data,
+        unit=form.unit.data,
+        unit_amt=float(form.unit_amt.data),
+        img_url=form.img_url.data,
+        description=form.description.data,
+        stock=form.stock.data or 0,
+    ), None
+
+
+def upsert_catalog_batch(rows):
+    insert = dialect_insert()
+    names = [row["name"] for row in rows]
+    prices = dict(db.session.execute(db.select(Item.name, Item.price).where(Item.name.in_(names))).all())
+
+    statement = insert(Item)
+    statement = statement.on_conflict_do_update(
+        index_elements=[Item.name],
+        set_={field: statement.excluded[field] for field in CATALOG_FIELDS if field != "name"},
+    )
+    db.session.execute(statement, [
+        dict(row, stripe_prod_id=pending_stripe_id(), stripe_price_id=pending_stripe_id()) for row in rows
+    ])
+
+    # Queue one Stripe sync task per changed item, folding into tasks that are already pending
+    ids = dict(db.session.execute(db.select(Item.name, Item.id).where(Item.name.in_(names))).all())
+    prod_ids = dict(db.session.execute(db.select(Item.id, Item.stripe_prod_id).where(Item.id.in_(ids.values()))).all())
+    repriced = [ids[row["name"]] for row in rows if row["name"] in prices and prices[row["name"]] != row["price"]]
+    if repriced:
+        refresh_cart_totals(carts_holding(repriced))
+    enqueue_stripe_syncs(prod_ids, {ids[row["name"]] for row in rows if prices.get(row["name"]) != row["price"]})
+
+    catalog.invalidate()
+    db.session.commit()
+
+
+def import_catalog(stream, file_format, batch_size=None):
+    """Validate and upsert catalog rows from a binary stream in batches. Returns (imported, errors, seconds), with
+    each error's "row" being its line in the file."""
+    batch_size = batch_size or app.config['CATALOG_IMPORT_BATCH_SIZE']
+    start = time.perf_counter()
+    imported, errors, batch = 0, [], {}
+    form = ItemForm(formdata=None, meta={'csrf': False})
+
+    for line_number, row in read_catalog_rows(stream, file_format):
+        if isinstance(row, str):
+            errors.append({"row": line_number, "errors": {"line": row}})
+            continue
+        values, row_errors = validate_catalog_row(form, row)
+        if row_errors:
+            errors.append({"row": line_number, "errors": row_errors})
+            continue
+        # Later rows for the same name win, matching what sequential upserts would do
+        batch[values["name"]] = values
+        if len(batch) >= batch_size:
+            upsert_catalog_batch(list(batch.values()))
+            imported += len(batch)
+            batch = {}
+
+    if batch:
+        upsert_catalog_batch(list(batch.values()))
+        imported += len(batch)
+    return imported, errors, time.perf_counter() - start
+
+
+def export_catalog(file_format):
+    # Stream rows straight from the cursor so large catalogs never sit in memory
+    rows = db.session.execute(
+        db.select(*[getattr(Item, field) for field in CATALOG_FIELDS]).order_by(Item.id).execution_options(yield_per=1000)
+    )
+    # Item.price is a Float column but ItemForm takes whole cents, so write it the way an import reads it
+    rows = (dict(zip(CATALOG_FIELDS, row), price=int(row.price)) for row in rows)
+    if file_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, CATALOG_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    else:
+        for row in rows:
+            yield json.dumps(row) + "\n"
+
+
+def catalog_file_format(filename, requested=None):
+    file_format = requested or ("csv" if filename.lower().endswith(".csv") else "jsonl")
+    if file_format not in ("csv", "jsonl"):
+        raise ValueError(f"Unsupported catalog format: {file_format}")
+    return file_format
+
+
+@app.cli.command("import-catalog")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(["csv", "jsonl"]), help="Defaults to the file extension.")
+@click.option("--batch-size", type=int, help="Rows per transaction.")
+def import_catalog_command(path, file_format, batch_size):
+    """Load products from a CSV or JSONL file."""
+    with open(path, "rb") as stream:
+        imported, errors, seconds = import_catalog(stream, catalog_file_format(path, file_format), batch_size)
+    for error in errors[:20]:
+        click.echo(f"row {error['row']}: {error['errors']}", err=True)
+    click.echo(f"Imported {imported} rows, rejected {len(errors)} in {seconds:.2f}s ({imported / max(seconds, 1e-9):.0f} rows/sec)")
+
+
+@app.cli.command("export-catalog")
+@click.argument("path", type=click.Path(dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(["csv", "jsonl"]), help="Defaults to the file extension.")
+def export_catalog_command(path, file_format):
+    """Write every product to a CSV or JSONL file."""
+    start = time.perf_counter()
+    with open(path, "w", newline="", encoding="utf-8") as stream:
+        for chunk in export_catalog(catalog_file_format(path, file_format)):
+            stream.write(chunk)
+    click.echo(f"Exported catalog in {time.perf_counter() - start:.2f}s")
+
+
+@app.route("/admin/catalog/import", methods=['POST'])
+@admin_only
+def catalog_import():
+    upload = request.files.get('file')
+    if not upload:
+        return jsonify(error="No file uploaded"), 400
+    try:
+        file_format = catalog_file_format(upload.filename, request.form.get('format'))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    imported, errors, seconds = import_catalog(upload.stream, file_format)
+    return jsonify(imported=imported, rejected=len(errors), errors=errors[:100], seconds=round(seconds, 3),
+                   rows_per_sec=round(imported / max(seconds, 1e-9)))
+
+
+@app.route("/admin/catalog/export.<string:file_format>", methods=['GET'])
+@admin_only
+def catalog_export(file_format):
+    if file_format not in ("csv", "jsonl"):
+        return abort(404)
+    mimetype = "text/csv" if file_format == "csv" else "application/x-ndjson"
+    return Response(stream_with_context(export_catalog(file_format)), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename=catalog.{file_format}"})
+
+#--- Static Asset Pipeline ---#
+# `flask build-assets` copies static files to static/dist under content-hashed names with gzip/brotli
+# siblings; templates link them through asset_url() and they're served with far-future immutable caching
+ASSET_DIR = os.path.join(app.static_folder, "dist")
+ASSET_MANIFEST = os.path.join(ASSET_DIR, "manifest.json")
+COMPRESSIBLE_ASSETS = {".css", ".js", ".svg", ".json", ".txt", ".html"}
+asset_manifest = {}
+asset_version = ""
+
+
+def load_asset_manifest():
+    global asset_manifest, asset_version
+    try:
+        with open(ASSET_MANIFEST, encoding="utf-8") as manifest:
+            asset_manifest = json.load(manifest)
+    except FileNotFoundError:
+        asset_manifest = {}
+    # Part of every page ETag, so pages pick up new asset names after a rebuild
+    asset_version = make_etag(*sorted(asset_manifest.values()))
+
+
+def build_assets():
+    """Fingerprint and precompress everything under static/. Returns (filename, raw, gzip, brotli) sizes."""
+    sources = []
+    for root, dirs, files in os.walk(app.static_folder):
+        dirs[:] = [name for name in dirs if os.path.join(root, name) != ASSET_DIR]
+        for name in files:
+            sources.append(os.path.relpath(os.path.join(root, name), app.static_folder).replace(os.sep, "/"))
+    # Stylesheets last, so the url()s inside them can point at already-hashed images
+    sources.sort(key=lambda filename: (filename.endswith(".css"), filename))
+
+    manifest, stats = {}, []
+    for filename in sources:
+        with open(os.path.join(app.static_folder, filename), "rb") as source:
+            content = source.read()
+        if filename.endswith(".css"):
+            text = content.decode("utf-8")
+            for original, hashed in manifest.items():
+                text = text.replace(f"/static/{original}", f"/assets/{hashed}")
+            content = text.encode("utf-8")
+
+        stem, ext = os.path.splitext(filename)
+        hashed = f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+        target = os.path.join(ASSET_DIR, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as output:
+            output.write(content)
+
+        gzip_size = brotli_size = None
+        if ext in COMPRESSIBLE_ASSETS:
+            compressed = gzip.compress(content, compresslevel=9, mtime=0)
+            with open(target + ".gz", "wb") as output:
+                output.write(compressed)
+            gzip_size = len(compressed)
+            if brotli:
+                compressed = brotli.compress(content, quality=11)
+                with open(target + ".br", "wb") as output:
+                    output.write(compressed)
+                brotli_size = len(compressed)
+
+        manifest[filename] = hashed
+        stats.append((filename, len(content), gzip_size, brotli_size))
+
+    with open(ASSET_MANIFEST, "w", encoding="utf-8") as output:
+        json.dump(manifest, output, indent=2, sort_keys=True)
+    load_asset_manifest()
+    return stats
+
+
+load_asset_manifest()
+
+
+@app.template_global()
+def asset_url(filename):
+    # Falls back to the plain static URL until `flask build-assets` has run
+    hashed = asset_manifest.get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+    return url_for('hashed_asset', filename=hashed)
+
+
+@app.route("/assets/<path:filename>")
+def hashed_asset(filename):
+    path = safe_join(ASSET_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        return abort(404)
+
+    # Serve a precompressed sibling when the client accepts it
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    encoding = None
+    for candidate, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if candidate in request.accept_encodings and os.path.isfile(path + suffix):
+            path, encoding = path + suffix, candidate
+            break
+
+    # The name changes whenever the content does, so the file can be cached forever
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=True, max_age=31536000)
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    """Write fingerprinted, precompressed copies of static/ and report bytes saved."""
+    stats = build_assets()
+    for filename, raw, gzip_size, brotli_size in stats:
+        click.echo(f"{filename}: {raw} B raw, {gzip_size or '-'} B gzip, {brotli_size or '-'} B brotli")
+    text = [(raw, min(size for size in (raw, gzip_size, brotli_size) if size)) for _, raw, gzip_size, brotli_size in stats if gzip_size]
+    raw_text, best_text = sum(raw for raw, _ in text), sum(best for _, best in text)
+    raw_total = sum(raw for _, raw, _, _ in stats)
+    click.echo(f"Text assets, first visit: {raw_text} B before, {best_text} B after ({100 - best_text * 100 / max(raw_text, 1):.0f}% less)")
+    click.echo(f"All assets, repeat visit: {raw_total} B re-downloaded or revalidated before, 0 B after (immutable cache)")
+    if not brotli:
+        click.echo("Install the brotli package to also write .br files")
+
+
+#--- Product Image Proxy ---#
+# Item.img_url is fetched once into a content-addressed disk cache and served as resized WebP/JPEG
+# variants, so the grid no longer hot-links full-size third-party images for every thumbnail
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', os.path.join(app.instance_path, "image-cache"))
+IMAGE_VARIANTS = {"thumb": (300, 300), "detail": (900, 900)}
+IMAGE_PLACEHOLDER = "assets/images/placeholder-logo.svg"
+app.config.setdefault('IMAGE_CACHE_MAX_BYTES', int(os.getenv('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024)))
+app.config.setdefault('IMAGE_FETCH_TIMEOUT', float(os.getenv('IMAGE_FETCH_TIMEOUT', 5)))
+app.config.setdefault('IMAGE_FETCH_MAX_BYTES', int(os.getenv('IMAGE_FETCH_MAX_BYTES', 10 * 1024 * 1024)))
+# Seconds a URL that failed to fetch or decode is answered with the placeholder before it's tried again
+app.config.setdefault('IMAGE_FAILURE_TTL', float(os.getenv('IMAGE_FAILURE_TTL', 300)))
+
+
+class ImageUnavailable(Exception):
+    pass
+
+
+class ImageCache:
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        # Running total of bytes on disk; the directory is only walked when it goes over budget
+        self._size = None
+
+    def _path(self, *parts):
+        path = os.path.join(self.root, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def read(self, *parts):
+        path = os.path.join(self.root, *parts)
+        try:
+            with open(path, "rb") as cached:
+                data = cached.read()
+        except FileNotFoundError:
+            return None
+        # mtime doubles as the LRU clock
+        os.utime(path)
+        return data
+
+    def write(self, data, *parts):
+        path = self._path(*parts)
+        temp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp, "wb") as output:
+            output.write(data)
+        os.replace(temp, path)
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data)
+        if self._size is None or self._size > app.config['IMAGE_CACHE_MAX_BYTES']:
+            self.evict()
+
+    def evict(self):
+        # Drop least recently used files until the cache fits its size budget
+        with self._lock:
+            files = []
+            for root, _, names in os.walk(self.root):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= app.config['IMAGE_CACHE_MAX_BYTES']:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._size = total
+
+
+image_cache = ImageCache(IMAGE_CACHE_DIR)
+
+
+def fetch_image_source(url):
+    # Images under static/ are read straight from disk (handy for seeding and offline testing)
+    if url.startswith("/static/"):
+        path = safe_join(app.static_folder, url[len("/static/"):])
+        if path is None:
+            raise ValueError(f"Unsafe image path: {url}")
+        with open(path, "rb") as source:
+            return source.read()
+    if not url.startswith(("http://", "https://")):
+        raise ValueError(f"Unsupported image URL: {url}")
+
+    request_ = urllib.request.Request(url, headers={"User-Agent": "online-shop-image-proxy"})
+    with urllib.request.urlopen(request_, timeout=app.config['IMAGE_FETCH_TIMEOUT']) as response:
+        data = response.read(app.config['IMAGE_FETCH_MAX_BYTES'] + 1)
+    if len(data) > app.config['IMAGE_FETCH_MAX_BYTES']:
+        raise ValueError(f"Image too large: {url}")
+    return data
+
+
+def image_url_key(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def remember_image_failure(url):
+    # Stands in for the url -> digest entry, so a dead or slow URL isn't fetched again on every request
+    image_cache.write(f"failed {time.time() + app.config['IMAGE_FAILURE_TTL']}".encode(), "urls", image_url_key(url))
+
+
+def source_image(url):
+    """Original bytes for a URL and their content hash, fetching at most once.
+    Raises ImageUnavailable while a recent failure for the URL is remembered."""
+    url_key = image_url_key(url)
+    digest = image_cache.read("urls", url_key)
+    if digest:
+        digest = digest.decode()
+        if digest.startswith("failed "):
+            if float(digest.split()[1]) > time.time():
+                raise ImageUnavailable(url)
+        else:
+            data = image_cache.read("objects", digest[:2], digest)
+            if data is not None:
+                return digest, data
+
+    data = fetch_image_source(url)
+    digest = hashlib.sha256(data).hexdigest()
+    image_cache.write(data, "objects", digest[:2], digest)
+    image_cache.write(digest.encode(), "urls", url_key)
+    return digest, data
+
+
+def render_variant(data, size, image_format):
+    with PILImage.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(size)
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format=image_format, quality=80, **({"method": 4} if image_format == "WEBP" else {"optimize": True, "progressive": True}))
+        return output.getvalue()
+
+
+@app.template_global()
+def item_image_url(item, variant="thumb"):
+    # The img_url hash in the query string busts browser caches when the image changes
+    return url_for('item_image', item_id=item.id, variant=variant, v=hashlib.sha1(item.img_url.encode()).hexdigest()[:10])
+
+
+@app.route("/img/<int:item_id>/<string:variant>")
+def item_image(item_id, variant):
+    if variant not in IMAGE_VARIANTS:
+        return abort(404)
+    img_url = db.session.execute(db.select(Item.img_url).where(Item.id == item_id)).scalar()
+    if img_url is None:
+        return abort(404)
+
+    try:
+        digest, data = source_image(img_url)
+        if PILImage is None:
+            # Without Pillow the cached original is served as-is
+            body, mimetype = data, mimetypes.guess_type(img_url.split("?")[0])[0] or "application/octet-stream"
+        else:
+            image_format = "WEBP" if "image/webp" in request.accept_mimetypes and features.check("webp") else "JPEG"
+            name = f"{digest}-{variant}.{image_format.lower()}"
+            body = image_cache.read("variants", digest[:2], name)
+            if body is None:
+                body = render_variant(data, IMAGE_VARIANTS[variant], image_format)
+                image_cache.write(body, "variants", digest[:2], name)
+            mimetype = f"image/{image_format.lower()}"
+    except ImageUnavailable:
+        return redirect(asset_url(IMAGE_PLACEHOLDER))
+    except Exception as e:
+        app.logger.warning("Image proxy falling back to placeholder for item %s: %s", item_id, e)
+        remember_image_failure(img_url)
+        return redirect(asset_url(IMAGE_PLACEHOLDER))
+
+    response = Response(body, mimetype=mimetype)
+    response.vary.add("Accept")
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    return response
 
 
 #--- Home Page ---#
 @app.route("/")
 def home():
-    db_items = db.session.execute(db.select(Item).order_by('id')).scalars()
-    items = [item for item in db_items]
-    return render_template("index.html", logged_in=current_user.is_authenticated, items=items)
+    version = catalog.version()
+    return cached_page(
+        make_etag("home", version, viewer_key()),
+        lambda: render_template("index.html", logged_in=current_user.is_authenticated, grid=item_grid(version, catalog.items(), "home")),
+    )
 
 
 #--- Account-Relevant Pages ---#
@@ -138,7 +1761,16 @@ def login():
         if not user:
             flash("That email does not have an account. Please try again.")
             return redirect(url_for("login", form=form))
-        elif not check_password_hash(user.password, password):
+        try:
+            verified = hasher.verify(user.password, password)
+            # Upgrade hashes made with older or cheaper settings while we have the plaintext
+            if verified and hasher.needs_rehash(user.password):
+                user.password = hasher.hash(password)
+                db.session.commit()
+        except HasherBusy:
+            flash("We're handling a lot of logins right now. Please try again in a moment.")
+            return redirect(url_for("login", form=form))
+        if not verified:
             flash("Incorrect password. Please try again.")
             return redirect(url_for("login", form=form))
         else:
@@ -158,7 +1790,11 @@ def sign_up():
     form = SignupForm()
     if form.validate_on_submit():
         email = form.email.data
-        hash_password = generate_password_hash(form.password.data, salt_length=8)
+        try:
+            hash_password = hasher.hash(form.password.data)
+        except HasherBusy:
+            flash("We're handling a lot of sign-ups right now. Please try again in a moment.")
+            return redirect(url_for("sign_up"))
         user = db.session.execute(db.select(User).where(User.email == email)).scalar()
         if not user:
             if email == os.getenv('ADMIN_EMAIL'):
@@ -202,6 +1838,7 @@ def edit_profile(user_name, user_id):
         user.email = form.email.data
 
         db.session.commit()
+        identities.invalidate(user.id)
         return redirect(url_for("home", logged_in=current_user.is_authenticated))
     return render_template("edit_profile.html", logged_in=current_user.is_authenticated, form=form)
 
@@ -213,10 +1850,15 @@ def change_password(user_name, user_id):
 
     if request.method == "POST":
         if form.validate_on_submit() and form.password.data == form.verify_pass.data:
-            hash_password = generate_password_hash(form.verify_pass.data, salt_length=8)
+            try:
+                hash_password = hasher.hash(form.verify_pass.data)
+            except HasherBusy:
+                flash("Please try again in a moment.")
+                return redirect(url_for("change_password", user_name=user_name, user_id=user_id))
             user.password = hash_password
 
             db.session.commit()
+            identities.invalidate(user.id)
             return redirect(url_for("home", logged_in=current_user.is_authenticated))
         else:
             flash("Password must match in both input fields.")
@@ -224,14 +1866,37 @@ def change_password(user_name, user_id):
     return render_template("change_password.html", logged_in=current_user.is_authenticated, form=form)
 
 
+app.config.setdefault('ORDER_PAGE_SIZE', int(os.getenv('ORDER_PAGE_SIZE', 20)))
+
+
 @app.route('/string:user_name>/my_orders', methods=["GET"])
+@query_budget(3)
 def my_orders():
-        return render_template("my_orders.html", logged_in=current_user.is_authenticated)
+        # Newest first, keyset-paginated on (created_at, id) so ix_orders_user_created serves both the filter
+        # and the ordering (SQLite appends the rowid to every index) and no page sorts the user's whole history
+        page_size = app.config['ORDER_PAGE_SIZE']
+        before = request.args.get('before', type=datetime.fromisoformat)
+        before_id = request.args.get('before_id', type=int)
+        query = db.select(Order).where(Order.user_id == current_user.id)
+        if before and before_id:
+            query = query.where(db.or_(Order.created_at < before, db.and_(Order.created_at == before, Order.id < before_id)))
+        orders = db.session.execute(query.order_by(Order.created_at.desc(), Order.id.desc()).limit(page_size + 1)).scalars().all()
+        last = orders[page_size - 1] if len(orders) > page_size else None
+        next_before = dict(before=last.created_at.isoformat(), before_id=last.id) if last else None
+        return render_template("my_orders.html", logged_in=current_user.is_authenticated, orders=orders[:page_size], next_before=next_before)
 
 
 @app.route('/string:user_name>/my_orders/<int:order_id>', methods=["GET"])
+@query_budget(4)
 def order(order_id):
-        order = db.get_or_404(Order, order_id)
+        # Load the order's items and their products up front instead of one lazy load per row
+        order = db.session.execute(
+            db.select(Order)
+            .options(selectinload(Order.items).joinedload(OrderItem.item))
+            .where(Order.id == order_id)
+        ).scalar()
+        if not order:
+            return abort(404)
         return render_template("order.html", logged_in=current_user.is_authenticated, order=order)
 
 
@@ -242,20 +1907,18 @@ def goto_item(item_id):
     # Grab current item
     item = db.get_or_404(Item, item_id) 
 
-    # Grab current cart if it exists
-    try:
-        if current_user.cart:
-            cart = current_user.cart
-            # If cart exists, retrieve OrderItem (if any) that corresponds to the current Item
-            order_item = db.session.execute(db.select(OrderItem).where(OrderItem.item_id == item_id, OrderItem.cart_id == cart.id)).scalar()
-        else:
-            order_item = Null
-    
     # Redirect anonymous user to login page
-    except AttributeError:
+    if not current_user.is_authenticated:
         return redirect(url_for('login'))
 
-    return render_template("item.html", logged_in=current_user.is_authenticated, item=item, order_item=order_item)
+    # If cart exists, retrieve OrderItem (if any) that corresponds to the current Item
+    order_item = db.session.execute(
+        db.select(OrderItem).join(Cart, OrderItem.cart_id == Cart.id).where(OrderItem.item_id == item_id, Cart.user_id == current_user.id)
+    ).scalar()
+
+    etag = make_etag("item", *[getattr(item, column.name) for column in Item.__table__.columns],
+                     order_item.quantity if order_item else 0, viewer_key())
+    return cached_page(etag, lambda: render_template("item.html", logged_in=current_user.is_authenticated, item=item, order_item=order_item))
 
 
 @app.route("/add-item", methods=['GET', 'POST'])
@@ -263,31 +1926,10 @@ def goto_item(item_id):
 def add_item():
     form = ItemForm()
     if form.validate_on_submit():
-        # Create new Product in Stripe db
-        new_product = stripe.Product.create(
-            name=form.name.data,
-            description=form.description.data,
-            metadata={
-                'category': form.category.data,
-                'unit': form.unit.data,
-                'unit_amt': form.unit_amt.data,
-                'stock': form.stock.data
-                },
-            images=[form.img_url.data]
-            )
-
-        # Create Price for new item in Stripe db
-        new_price = stripe.Price.create(
-            product=new_product.id,
-            currency="usd",
-            unit_amount=form.price.data,
-            nickname=form.name.data,
-        )
-
-        # Create Item in local db
+        # Create Item in local db; the Stripe Product and Price are created by the sync worker
         new_item = Item(
-            stripe_prod_id = new_product.id,
-            stripe_price_id = new_price.id,
+            stripe_prod_id = pending_stripe_id(),
+            stripe_price_id = pending_stripe_id(),
             name = form.name.data,
             category = form.category.data,
             price = form.price.data,
@@ -299,11 +1941,40 @@ def add_item():
         )
 
         db.session.add(new_item)
+        db.session.flush()
+        enqueue_stripe_sync(new_item, "upsert", price_changed=True)
+        catalog.invalidate()
         db.session.commit()
         return redirect(url_for("home", logged_in=current_user.is_authenticated))
     return render_template("add_item.html", current_user=current_user, form=form, logged_in=current_user.is_authenticated)
 
 
+def item_changes(form, item):
+    """The ItemForm fields whose submitted value differs from the stored Item, as {field: new value}."""
+    changes = {}
+    for field in CATALOG_FIELDS:
+        if field == "stock":
+            continue
+        value = form[field].data
+        current = getattr(item, field)
+        # Float columns come back from the form as int/Decimal; compare like for like
+        if isinstance(current, float) and value is not None:
+            value = float(value)
+        if value != current:
+            changes[field] = value
+
+    # Checkouts take stock while the form is open, so apply the admin's adjustment as a delta against the
+    # value the form was rendered with instead of writing back that (possibly stale) number
+    try:
+        original_stock = int(form.original_stock.data)
+    except (TypeError, ValueError):
+        original_stock = item.stock
+    if form.stock.data is not None and form.stock.data != original_stock:
+        # Clamped at zero: reservations taken meanwhile may already cover more than the admin removed
+        changes["stock"] = sql_greatest(Item.stock + (form.stock.data - original_stock), 0)
+    return changes
+
+
 @app.route("/edit-item/<int:item_id>", methods=["GET", "POST", "UPDATE"])
 @admin_only
 def edit_item(item_id):
@@ -316,48 +1987,24 @@ def edit_item(item_id):
         unit_amt = item.unit_amt,
         img_url = item.img_url,
         description = item.description,
-        stock = item.stock
+        stock = item.stock,
+        original_stock = item.stock
     )
 
     if form.validate_on_submit():
-        # Modify associated product in Stripe db
-        stripe.Product.modify(item.stripe_prod_id,
-                              name=form.name.data,
-                              description=form.description.data,
-                              metadata={
-                                  'category': form.category.data,
-                                  'unit': form.unit.data,
-                                  'unit_amt': form.unit_amt.data,
-                                  'stock': form.stock.data
-                                  },
-                              images=[form.img_url.data])
-        
-        if form.price.data != item.price:
-            # Inactivate old Price
-            stripe.Price.modify(item.stripe_price_id, active=False)
-
-            # Create new Price for Product in Stripe db
-            new_price = stripe.Price.create(
-                product=item.stripe_prod_id,
-                currency="usd",
-                unit_amount=form.price.data,
-                nickname=form.name.data,
-            )
-
-            # Modify produce price in local db
-            item.stripe_price_id = new_price.id
-
-        # Modify product in local db
-        item.name = form.name.data
-        item.category = form.category.data
-        item.price = form.price.data
-        item.unit = form.unit.data
-        item.unit_amt = form.unit_amt.data
-        item.img_url = form.img_url.data
-        item.description = form.description.data
-        item.stock = form.stock.data
-
-        db.session.commit()
+        # Write only the fields that changed; a resubmitted form with no edits touches neither the db nor Stripe
+        changes = item_changes(form, item)
+        if changes:
+            for field, value in changes.items():
+                setattr(item, field, value)
+
+            # Price changes rotate the Stripe Price once the sync worker picks up the edit
+            price_changed = "price" in changes
+            if price_changed:
+                refresh_cart_totals(carts_holding([item.id]))
+            enqueue_stripe_sync(item, "upsert", price_changed=price_changed, product_changed=bool(changes.keys() - {"price"}))
+            catalog.invalidate()
+            db.session.commit()
         return redirect(url_for("home", logged_in=current_user.is_authenticated, item_id=item.id))
     return render_template("edit_item.html", logged_in=current_user.is_authenticated, current_user=current_user, editing=True, form=form, item=item)
 
@@ -369,153 +2016,694 @@ def confirm_delete_item(item_id):
     form = ConfirmDeleteForm()
 
     if form.validate_on_submit():
-        # Inactivate Product in Stripe db
-        stripe.Product.modify(item_to_delete.stripe_prod_id, active=False)
-
-        # Delete product in local db
+        # Inactivate Product in Stripe db via the sync worker
+        enqueue_stripe_sync(item_to_delete, "deactivate")
+
+        # Delete product in local db, along with any cart lines still pointing at it (order lines are kept)
+        cart_ids = db.session.execute(
+            db.select(OrderItem.cart_id).where(OrderItem.item_id == item_id, OrderItem.cart_id.is_not(None))
+        ).scalars().all()
+        db.session.execute(db.delete(OrderItem).where(OrderItem.item_id == item_id, OrderItem.order_id.is_(None)))
         db.session.delete(item_to_delete)
+        db.session.flush()
+        refresh_cart_totals(Cart.id.in_(cart_ids))
+        catalog.invalidate()
         db.session.commit()
         return redirect(url_for("home", logged_in=current_user.is_authenticated))
     return render_template("delete_item.html", logged_in=current_user.is_authenticated, form=form)
 
 
+@app.route("/admin/stripe-sync", methods=['GET'])
+@admin_only
+def stripe_sync_status():
+    counts = dict(db.session.execute(db.select(StripeSyncTask.status, db.func.count()).group_by(StripeSyncTask.status)).all())
+    now = time.time()
+    counts['stalled'] = db.session.execute(db.select(db.func.count()).select_from(StripeSyncTask).where(stalled_tasks(now))).scalar()
+    tasks = db.session.execute(
+        db.select(StripeSyncTask).where(StripeSyncTask.status != "done").order_by(StripeSyncTask.id).limit(100)
+    ).scalars().all()
+    return render_template("stripe_sync.html", logged_in=current_user.is_authenticated, counts=counts, tasks=tasks,
+                           stalled_before=now - app.config['STRIPE_SYNC_LEASE'])
+
+
+def reprice_items(percent, category=None):
+    """Scale prices by `percent` in one transaction and queue a Price rotation for each item that changed.
+    Returns the number of items repriced."""
+    new_price = db.func.round(Item.price * (1 + float(percent) / 100))
+    criteria = [new_price != Item.price, new_price >= 1]
+    if category:
+        criteria.append(Item.category == category)
+    repriced = db.session.execute(
+        db.update(Item).where(*criteria).values(price=new_price).returning(Item.id, Item.stripe_prod_id)
+    ).all()
+    if repriced:
+        prod_ids = dict(repriced)
+        refresh_cart_totals(carts_holding(list(prod_ids)))
+        enqueue_stripe_syncs(prod_ids, set(prod_ids), product_changed=False)
+        catalog.invalidate()
+    db.session.commit()
+    return len(repriced)
+
+
+@app.route("/admin/reprice", methods=['GET', 'POST'])
+@admin_only
+def reprice():
+    form = RepriceForm()
+    if form.validate_on_submit():
+        count = reprice_items(form.percent.data, form.category.data)
+        flash(f"Repriced {count} item(s); Stripe prices will rotate as the sync queue drains.")
+        return redirect(url_for("reprice"))
+    return render_template("reprice.html", logged_in=current_user.is_authenticated, form=form)
+
+
+@app.cli.command("reprice")
+@click.option("--percent", type=float, required=True, help="Price change, e.g. 5 for +5% or -10 for a 10% markdown.")
+@click.option("--category", type=click.Choice([value for value, label in CATEGORY_CHOICES]), help="Defaults to every product.")
+@click.option("--sync", is_flag=True, help="Push the new prices to Stripe before exiting.")
+@click.option("--concurrency", type=int, help="Parallel Stripe requests while syncing.")
+def reprice_command(percent, category, sync, concurrency):
+    """Apply a percentage price change to the catalog."""
+    if percent <= -100:
+        raise click.BadParameter("must be greater than -100", param_hint="--percent")
+    start = time.perf_counter()
+    click.echo(f"Repriced {reprice_items(percent, category)} item(s) in {time.perf_counter() - start:.2f}s")
+    if sync:
+        start = time.perf_counter()
+        synced = 0
+        while processed := process_stripe_outbox(concurrency=concurrency):
+            synced += processed
+        click.echo(f"Synced {synced} task(s) to Stripe in {time.perf_counter() - start:.2f}s")
+
+
 
 #--- Cart-Relevant Pages ---#
+def get_cart_id(user_id):
+    # Create the user's cart if needed without a separate commit or a race on concurrent first clicks.
+    # Always asks the database: a cached principal's cart_id may be stale if another worker finalized the cart
+    created = db.session.execute(
+        dialect_insert()(Cart).values(user_id=user_id, updated_at=time.time()).on_conflict_do_nothing(index_elements=[Cart.user_id])
+    ).rowcount
+    if created:
+        identities.invalidate(user_id)
+    return db.session.execute(db.select(Cart.id).where(Cart.user_id == user_id)).scalar()
+
+
+def carts_holding(item_ids):
+    return Cart.id.in_(db.select(OrderItem.cart_id).where(OrderItem.item_id.in_(item_ids), OrderItem.cart_id.is_not(None)))
+
+
+def refresh_cart_totals(*criteria, **values):
+    """Recompute item_count/subtotal_cents (and set any extra values) for the matching carts in one statement.
+    Returns {cart_id: (count, cents)}."""
+    def total(expression):
+        # Lines whose item has been deleted drop out of both totals
+        return (db.select(db.func.coalesce(db.func.sum(expression), 0))
+                .join(Item, Item.id == OrderItem.item_id)
+                .where(OrderItem.cart_id == Cart.id)
+                .scalar_subquery())
+
+    totals = db.session.execute(
+        db.update(Cart).where(*criteria).values(
+            item_count=total(OrderItem.quantity),
+            subtotal_cents=db.cast(db.func.round(total(OrderItem.quantity * Item.price)), db.Integer),
+            **values,
+        ).returning(Cart.id, Cart.item_count, Cart.subtotal_cents)
+    ).all()
+    return {cart_id: (item_count, subtotal_cents) for cart_id, item_count, subtotal_cents in totals}
+
+
+def change_cart_quantities(cart_id, changes):
+    """Apply {item_id: delta} to a cart atomically in the database; quantities never drop below 0.
+    Returns the cart's new (item_count, subtotal_cents)."""
+    statement = dialect_insert()(OrderItem).values(
+        cart_id=db.bindparam("cart_id"), item_id=db.bindparam("item_id"), quantity=db.bindparam("initial"))
+    statement = statement.on_conflict_do_update(
+        index_elements=[OrderItem.cart_id, OrderItem.item_id],
+        set_={"quantity": db.case(
+            (OrderItem.quantity + db.bindparam("delta") < 0, 0),
+            else_=OrderItem.quantity + db.bindparam("delta"),
+        )},
+    )
+    db.session.execute(statement, [
+        {"cart_id": cart_id, "item_id": item_id, "initial": max(delta, 0), "delta": delta} for item_id, delta in changes.items()
+    ])
+    return refresh_cart_totals(Cart.id == cart_id, updated_at=time.time())[cart_id]
+
+
 @app.route('/add-to-cart/<int:item_id>/<increment>')
+@query_budget(5)
 def cart_add(item_id, increment):
-    try:
-        if not current_user.cart:
-            cart = Cart(
-                user_id=current_user.id, 
-                customer=current_user
-                )
-                
-            db.session.add(cart)
-            db.session.commit()
-        else:
-            cart = current_user.cart
-    
     # Redirect anonymous user to login page
-    except AttributeError:
+    if not current_user.is_authenticated:
         return redirect(url_for('login'))
 
+    # Add or remove 1 qty of the current item from the cart
+    delta = {'plus': 1, 'minus': -1}.get(increment)
+    if delta:
+        change_cart_quantities(get_cart_id(current_user.id), {item_id: delta})
+        db.session.commit()
+    return redirect(url_for("goto_item", item_id=item_id, logged_in=current_user.is_authenticated))
 
-    filter_item = db.session.query(OrderItem).filter(OrderItem.item_id == item_id, OrderItem.cart_id == cart.id)
-    search_item = db.session.execute(db.select(OrderItem).where(OrderItem.item_id == item_id, OrderItem.cart_id == cart.id)).scalar()
 
-    # If the cart has no items or if the current item being added is not yet in the cart, creates a new OrderItem and adds it to the cart
-    if not cart.items or not filter_item or not search_item:
-        order_item = OrderItem(
-        item_id=item_id,
-        quantity=0,
-        parent_cart=cart
-        )
-        print(order_item.quantity)
+@app.route('/cart/items', methods=['POST'])
+@query_budget(7)
+def cart_update():
+    # JSON body: {"changes": [{"item_id": 1, "delta": 2}, ...]}; returns the new quantities and cart totals
+    if not current_user.is_authenticated:
+        return jsonify(error="Login required"), 401
 
-        db.session.add(order_item)
-    else:
-        order_item = search_item
-        print(order_item.quantity)
+    changes = {}
+    try:
+        for change in (request.get_json(silent=True) or {}).get('changes', []):
+            item_id, delta = int(change['item_id']), int(change['delta'])
+            changes[item_id] = changes.get(item_id, 0) + delta
+    except (KeyError, TypeError, ValueError):
+        return jsonify(error="Each change needs an integer item_id and delta"), 400
+
+    existing = set(db.session.execute(db.select(Item.id).where(Item.id.in_(changes))).scalars())
+    changes = {item_id: delta for item_id, delta in changes.items() if item_id in existing and delta}
+    if not changes:
+        return jsonify(quantities={})
+
+    cart_id = get_cart_id(current_user.id)
+    item_count, subtotal_cents = change_cart_quantities(cart_id, changes)
+    quantities = dict(db.session.execute(
+        db.select(OrderItem.item_id, OrderItem.quantity).where(OrderItem.cart_id == cart_id, OrderItem.item_id.in_(changes))
+    ).all())
+    db.session.commit()
+    return jsonify(quantities={str(item_id): quantity for item_id, quantity in quantities.items()},
+                   cart={"item_count": item_count, "subtotal_cents": subtotal_cents})
 
-    # Add or remove 1 qty of the current item from the cart
-    if increment == 'plus':
-        order_item.quantity += 1
-    elif increment == 'minus' and order_item.quantity > 0:
-        order_item.quantity -= 1
 
+def cart_summary():
+    """The current user's (item_count, subtotal_cents), read once per request from the cart row."""
+    if 'cart_summary' not in g:
+        row = None
+        if current_user.is_authenticated:
+            row = db.session.execute(db.select(Cart.item_count, Cart.subtotal_cents).where(Cart.user_id == current_user.id)).first()
+        g.cart_summary = tuple(row) if row else (0, 0)
+    return g.cart_summary
+
+
+@app.context_processor
+def inject_cart_summary():
+    return dict(cart_summary=cart_summary)
+
+
+@app.route('/cart')
+def cart():
+    if not current_user.is_authenticated:
+        return redirect(url_for('login'))
+
+    lines = db.session.execute(
+        db.select(Item, OrderItem.quantity)
+        .join(OrderItem, OrderItem.item_id == Item.id)
+        .join(Cart, OrderItem.cart_id == Cart.id)
+        .where(Cart.user_id == current_user.id, OrderItem.quantity > 0)
+        .order_by(OrderItem.id)
+    ).all()
+    return render_template("cart.html", logged_in=current_user.is_authenticated, lines=lines)
+
+
+@setup_step
+def backfill_cart_totals():
+    # Carts created before the running totals and idle tracking existed
+    refresh_cart_totals(Cart.item_count.is_(None))
+    db.session.execute(db.update(Cart).where(Cart.updated_at.is_(None)).values(updated_at=time.time()))
     db.session.commit()
-    return redirect(url_for("goto_item", item_id=item_id, logged_in=current_user.is_authenticated))
 
 
-@app.route('/create-checkout-session', methods=['GET', 'POST'])
-def create_checkout_session():
-    # Attempts to pull current user's cart (if any). Redirects user to empty cart page if no cart found
-    cart = current_user.cart
-    cart_qty = 0
+#--- Inventory Reservations ---#
+# Stock is taken with a conditional UPDATE when checkout starts, so two checkouts can never both
+# claim the last unit; the hold is kept on success and returned on cancel or after the TTL
+app.config.setdefault('STOCK_RESERVATION_TTL', int(os.getenv('STOCK_RESERVATION_TTL', 1800)))
+app.config.setdefault('STOCK_SWEEP_INTERVAL', float(os.getenv('STOCK_SWEEP_INTERVAL', 60)))
+
+
+class OutOfStock(Exception):
+    def __init__(self, item_id):
+        super().__init__(f"Not enough stock for item {item_id}")
+        self.item_id = item_id
+
+
+def release_reservations(*criteria):
+    """Return held stock matching the criteria to the shelf. Returns the number of reservations released."""
+    # Flip the status first; only the transaction that flips a row gets to return its stock
+    reservations = StockReservation.__table__
+    released = db.session.execute(
+        db.update(reservations)
+        .where(reservations.c.status == "held", *criteria)
+        .values(status="released")
+        .returning(reservations.c.item_id, reservations.c.quantity)
+    ).all()
+
+    restock = {}
+    for item_id, quantity in released:
+        restock[item_id] = restock.get(item_id, 0) + quantity
+    if restock:
+        db.session.execute(
+            db.update(Item.__table__)
+            .where(Item.__table__.c.id == db.bindparam("item_id"))
+            .values(stock=Item.__table__.c.stock + db.bindparam("quantity")),
+            [{"item_id": item_id, "quantity": quantity} for item_id, quantity in restock.items()],
+        )
+    return len(released)
+
+
+def reserve_stock(cart_id, quantities, checkout_session_id=None):
+    """Hold {item_id: quantity} for a cart, replacing any earlier hold. Raises OutOfStock and rolls back if any item is short."""
+    release_reservations(StockReservation.cart_id == cart_id)
+    expires_at = time.time() + app.config['STOCK_RESERVATION_TTL']
+    lines = [{"item_id": item_id, "quantity": quantity} for item_id, quantity in sorted(quantities.items())]
+    take_stock = (
+        db.update(Item.__table__)
+        .where(Item.__table__.c.id == db.bindparam("item_id"), Item.__table__.c.stock >= db.bindparam("quantity"))
+        .values(stock=Item.__table__.c.stock - db.bindparam("quantity"))
+    )
+    try:
+        # One executemany; its summed rowcount tells us whether every line was filled
+        filled = db.engine.dialect.supports_sane_multi_rowcount and db.session.execute(take_stock, lines).rowcount == len(lines)
+        if not filled:
+            if db.engine.dialect.supports_sane_multi_rowcount:
+                db.session.rollback()
+                release_reservations(StockReservation.cart_id == cart_id)
+            # Line by line, so the short item is the one whose UPDATE missed (a concurrent restock may also let it through)
+            for line in lines:
+                if not db.session.execute(take_stock, line).rowcount:
+                    raise OutOfStock(line["item_id"])
+        db.session.execute(db.insert(StockReservation), [
+            dict(line, cart_id=cart_id, status="held", expires_at=expires_at, checkout_session_id=checkout_session_id) for line in lines
+        ])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return expires_at
+
+
+def session_reservations(session_id):
+    """The stock hold behind a Checkout Session, i.e. exactly what it charged for, as (id, item_id, quantity, status) rows.
+    Revisiting checkout re-takes the hold under the same session, so only the latest set counts."""
+    reservations = StockReservation.__table__
+    latest = db.select(db.func.max(reservations.c.expires_at)).where(reservations.c.checkout_session_id == session_id).scalar_subquery()
+    return db.session.execute(
+        db.select(reservations.c.id, reservations.c.item_id, reservations.c.quantity, reservations.c.status)
+        .where(reservations.c.checkout_session_id == session_id, reservations.c.expires_at == latest)
+    ).all()
+
+
+def commit_reservations(session_id, cart_id, held):
+    """Keep the stock a paid session was holding (`held` from session_reservations). If the hold was already released
+    (cancel or TTL sweep while the session stayed payable), take the stock again with the same conditional UPDATE;
+    returns the item ids that were short."""
+    reservations = StockReservation.__table__
+    db.session.execute(
+        db.update(reservations)
+        .where(reservations.c.status == "held", db.or_(
+            reservations.c.id.in_([row.id for row in held if row.status == "held"]),
+            # Holds taken before reservations recorded their session
+            db.and_(reservations.c.cart_id == cart_id, reservations.c.checkout_session_id.is_(None)),
+        ))
+        .values(status="committed")
+    )
 
-    print(cart)
+    short = []
+    for row in held:
+        if row.status != "released":
+            continue
+        db.session.execute(db.update(reservations).where(reservations.c.id == row.id).values(status="committed"))
+        taken = db.session.execute(
+            db.update(Item.__table__)
+            .where(Item.__table__.c.id == row.item_id, Item.__table__.c.stock >= row.quantity)
+            .values(stock=Item.__table__.c.stock - row.quantity)
+        ).rowcount
+        if not taken:
+            short.append(row.item_id)
+    return short
+
+
+def release_expired_reservations():
+    released = release_reservations(StockReservation.expires_at < time.time())
+    db.session.commit()
+    return released
+
+
+class ReservationSweeper(threading.Thread):
+    def __init__(self, interval=None):
+        super().__init__(name="stock-sweeper", daemon=True)
+        self.interval = interval or app.config['STOCK_SWEEP_INTERVAL']
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with app.app_context():
+                try:
+                    release_expired_reservations()
+                except Exception as e:
+                    app.logger.exception("Stock sweep failed: %s", e)
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        self.stopped.set()
+
+
+@app.cli.command("release-expired-reservations")
+def release_expired_reservations_command():
+    """Return stock held by checkouts that were never completed."""
+    click.echo(f"Released {release_expired_reservations()} reservation(s)")
+
+
+@app.cli.command("bench-cart-writes")
+@click.option("--writers", default=8, help="Threads upserting cart rows.")
+@click.option("--readers", default=8, help="Threads reading carts at the same time.")
+@click.option("--writes", default=200, help="Upserts per writer.")
+def bench_cart_writes(writers, readers, writes):
+    """Compare concurrent cart upserts on SQLite with and without WAL and busy_timeout."""
+    upsert = ("INSERT INTO cart_items (cart_id, item_id, quantity) VALUES (?, ?, 1) "
+              "ON CONFLICT (cart_id, item_id) DO UPDATE SET quantity = quantity + 1")
+
+    settings = [
+        ("rollback journal, no busy_timeout", False, 0),
+        ("rollback journal, busy_timeout", False, app.config['SQLITE_BUSY_TIMEOUT']),
+        ("WAL, busy_timeout", True, app.config['SQLITE_BUSY_TIMEOUT']),
+    ]
+    for label, wal, busy_timeout in settings:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db")
+            setup = sqlite3.connect(path)
+            configure_sqlite_connection(setup, wal, busy_timeout)
+            setup.execute("CREATE TABLE cart_items (cart_id INTEGER, item_id INTEGER, quantity INTEGER, UNIQUE (cart_id, item_id))")
+            setup.commit()
+            setup.close()
+
+            done = threading.Event()
+            failures, reads, written = [], [], []
+
+            def writer(cart_id):
+                # journal_mode persists in the file, so only the per-connection pragmas are set here
+                connection = sqlite3.connect(path, timeout=0, check_same_thread=False)
+                connection.execute(f"PRAGMA busy_timeout={busy_timeout}")
+                connection.execute(f"PRAGMA synchronous={'NORMAL' if wal else 'FULL'}")
+                for n in range(writes):
+                    try:
+                        connection.execute(upsert, (cart_id, n % 10))
+                        connection.commit()
+                        written.append(1)
+                    except sqlite3.OperationalError:
+                        connection.rollback()
+                        failures.append(1)
+                connection.close()
+
+            def reader():
+                # journal_mode persists in the file, so only the per-connection pragmas are set here
+                connection = sqlite3.connect(path, timeout=0, check_same_thread=False)
+                connection.execute(f"PRAGMA busy_timeout={busy_timeout}")
+                connection.execute(f"PRAGMA synchronous={'NORMAL' if wal else 'FULL'}")
+                count = 0
+                while not done.is_set():
+                    try:
+                        connection.execute("SELECT item_id, quantity FROM cart_items WHERE cart_id = ?", (count % writers,)).fetchall()
+                        count += 1
+                    except sqlite3.OperationalError:
+                        failures.append(1)
+                reads.append(count)
+                connection.close()
+
+            reader_threads = [threading.Thread(target=reader) for _ in range(readers)]
+            writer_threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+            start = time.perf_counter()
+            for thread in reader_threads + writer_threads:
+                thread.start()
+            for thread in writer_threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            done.set()
+            for thread in reader_threads:
+                thread.join()
+
+            click.echo(f"{label}: {len(written) / elapsed:.0f} writes/sec, "
+                       f"{sum(reads) / elapsed:.0f} reads/sec, {len(failures)} locked errors")
+
+
+app.config.setdefault('CHECKOUT_SESSION_REUSE_MARGIN', int(os.getenv('CHECKOUT_SESSION_REUSE_MARGIN', 300)))
+
+
+def prepare_checkout():
+    """Validate the current user's cart and hold its stock. Returns (response, None) to stop early, or (None, checkout)."""
+    # Attempts to pull current user's cart (if any). Redirects user to empty cart page if no cart found
+    cart = db.session.execute(
+        db.select(Cart)
+        .options(selectinload(Cart.items).joinedload(OrderItem.item))
+        .where(Cart.user_id == current_user.id)
+    ).scalar()
 
     if cart == None:
-        return redirect(url_for("empty", logged_in=current_user.is_authenticated))
+        return redirect(url_for("empty", logged_in=current_user.is_authenticated)), None
     else:
-        for item in cart.items:
-            cart_qty += item.quantity
-        if cart_qty == 0:
-            return redirect(url_for("empty", logged_in=current_user.is_authenticated))
-    
-        # Attempts to create a checkout.Session and populates line_items with contents of cart. Returns error if unsuccessful
+        if cart.item_count == 0:
+            return redirect(url_for("empty", logged_in=current_user.is_authenticated)), None
+
+        # Lines for items deleted from the catalog can't be bought
+        lines = [order_item for order_item in cart.items if order_item.quantity > 0 and order_item.item is not None]
+        if not lines:
+            return redirect(url_for("empty", logged_in=current_user.is_authenticated)), None
+
+        # Items still waiting on the Stripe sync worker have no real Price yet
+        if any(is_pending_stripe_id(order_item.item.stripe_price_id) for order_item in lines):
+            flash("Some items in your cart are still being set up. Please try again in a moment.")
+            return redirect(url_for("home", logged_in=current_user.is_authenticated)), None
+
+        # Hold stock for the cart before sending the customer to pay; read the line items first
+        # because the reservation commit expires the loaded cart
+        cart_id = cart.id
+        line_items = [{'price': f'{order_item.item.stripe_price_id}', 'quantity': order_item.quantity} for order_item in lines]
+        quantities = {order_item.item_id: order_item.quantity for order_item in lines}
+        fingerprint = hashlib.sha256(json.dumps(line_items, sort_keys=True).encode()).hexdigest()
+        reusable = (cart.checkout_session_id and cart.checkout_fingerprint == fingerprint
+                    and cart.checkout_expires_at > time.time() + app.config['CHECKOUT_SESSION_REUSE_MARGIN'])
+        checkout_url = cart.checkout_url
         try:
-            checkout_session = stripe.checkout.Session.create(
-                shipping_address_collection={"allowed_countries": ["US", "CA"]},
-                shipping_options=[
-                {
-                    "shipping_rate_data": {
-                    "type": "fixed_amount",
-                    "fixed_amount": {"amount": 0, "currency": "usd"},
-                    "display_name": "Free shipping",
-                    "delivery_estimate": {
-                        "minimum": {"unit": "business_day", "value": 5},
-                        "maximum": {"unit": "business_day", "value": 7},
-                    },
-                    },
-                },
-                {
-                    "shipping_rate_data": {
-                    "type": "fixed_amount",
-                    "fixed_amount": {"amount": 500, "currency": "usd"},
-                    "display_name": "Two-day shipping",
-                    "delivery_estimate": {
-                        "minimum": {"unit": "business_day", "value": 2},
-                        "maximum": {"unit": "business_day", "value": 2},
-                    },
-                    },
-                },
-                {
-                    "shipping_rate_data": {
-                    "type": "fixed_amount",
-                    "fixed_amount": {"amount": 1500, "currency": "usd"},
-                    "display_name": "Next day air",
-                    "delivery_estimate": {
-                        "minimum": {"unit": "business_day", "value": 1},
-                        "maximum": {"unit": "business_day", "value": 1},
-                    },
-                    },
-                },
-                ],
-                line_items=[{'price': f'{order_item.item.stripe_price_id}', 'quantity': order_item.quantity} for order_item in cart.items if order_item.quantity > 0],
-                mode='payment',
-                success_url= YOUR_DOMAIN + 'success',
-                cancel_url= YOUR_DOMAIN + 'cancel',
-            )
-        except Exception as e:
-            return str(e)
+            reserve_stock(cart_id, quantities, cart.checkout_session_id if reusable else None)
+        except OutOfStock as e:
+            flash("Sorry, we don't have enough of this item in stock to fill your cart.")
+            return redirect(url_for("goto_item", item_id=e.item_id, logged_in=current_user.is_authenticated)), None
+    
+        # Send the customer back to the open session if the cart hasn't changed since it was created
+        if reusable:
+            return redirect(checkout_url, code=303), None
+    return None, {'cart_id': cart_id, 'line_items': line_items, 'fingerprint': fingerprint}
+
+
+def checkout_session_params(checkout):
+    return dict(
+        shipping_address_collection={"allowed_countries": ["US", "CA"]},
+        shipping_options=SHIPPING_OPTIONS,
+        line_items=checkout['line_items'],
+        mode='payment',
+        client_reference_id=str(checkout['cart_id']),
+        metadata={'cart_id': checkout['cart_id'], 'user_id': current_user.id},
+        # Expire the session with the stock hold (Stripe requires at least 30 minutes)
+        expires_at=int(time.time() + max(app.config['STOCK_RESERVATION_TTL'], 1800)),
+        success_url= YOUR_DOMAIN + 'success?session_id={CHECKOUT_SESSION_ID}',
+        cancel_url= YOUR_DOMAIN + 'cancel',
+    )
+
 
+def checkout_failed(checkout, error):
+    release_reservations(StockReservation.cart_id == checkout['cart_id'])
+    db.session.commit()
+    return str(error)
+
+
+def store_checkout_session(checkout, checkout_session):
+    db.session.execute(db.update(Cart).where(Cart.id == checkout['cart_id']).values(
+        checkout_session_id=checkout_session.id,
+        checkout_url=checkout_session.url,
+        checkout_fingerprint=checkout['fingerprint'],
+        checkout_expires_at=checkout_session.expires_at,
+    ))
+    db.session.execute(
+        db.update(StockReservation)
+        .where(StockReservation.cart_id == checkout['cart_id'], StockReservation.status == "held",
+               StockReservation.checkout_session_id.is_(None))
+        .values(checkout_session_id=checkout_session.id)
+    )
+    db.session.commit()
     return redirect(checkout_session.url, code=303)
 
 
-@app.route('/success', methods=['GET', 'POST'])
-def success():
-    # Create Order and links cart items to it
-    cart = current_user.cart
-    order = Order(
-        user_id = current_user.id,
-        date = date.today().strftime("%m/%d/%Y")
+@app.route('/create-checkout-session', methods=['GET', 'POST'])
+@query_budget(9)
+def create_checkout_session():
+    response, checkout = prepare_checkout()
+    if response is not None:
+        return response
+
+    # Attempts to create a checkout.Session and populates line_items with contents of cart. Returns error if unsuccessful
+    try:
+        checkout_session = stripe_api.checkout.Session.create(**checkout_session_params(checkout))
+    except Exception as e:
+        return checkout_failed(checkout, e)
+    return store_checkout_session(checkout, checkout_session)
+
+
+
+#--- Order Finalization ---#
+# Orders are created from Stripe's checkout.session.completed webhook, keyed by session id,
+# so reloads, lost redirects and replayed events all finalize a checkout exactly once
+app.config.setdefault('STRIPE_WEBHOOK_SECRET', os.getenv('STRIPE_WEBHOOK_SECRET'))
+
+
+def record_paid_lines(order_id, cart_id, paid, session_id):
+    """Write the order's lines from what the session paid for ({item_id: quantity}) and take them out of the cart.
+    Anything added to the cart after the session was created stays there for the next checkout."""
+    prices = dict(db.session.execute(db.select(Item.id, Item.price).where(Item.id.in_(paid))).all())
+    db.session.execute(db.insert(OrderItem), [
+        dict(order_id=order_id, item_id=item_id, quantity=quantity, price=prices.get(item_id)) for item_id, quantity in paid.items()
+    ])
+    if not cart_id:
+        return
+
+    in_cart = dict(db.session.execute(
+        db.select(OrderItem.item_id, OrderItem.quantity).where(OrderItem.cart_id == cart_id, OrderItem.quantity > 0)
+    ).all())
+    if in_cart != paid:
+        app.logger.warning("Cart %s changed after checkout session %s was created: paid for %s, cart holds %s",
+                           cart_id, session_id, paid, in_cart)
+
+    lines = OrderItem.__table__
+    db.session.execute(
+        db.update(lines)
+        .where(lines.c.cart_id == cart_id, lines.c.item_id == db.bindparam("paid_item_id"))
+        .values(quantity=lines.c.quantity - db.bindparam("paid_quantity")),
+        [{"paid_item_id": item_id, "paid_quantity": quantity} for item_id, quantity in paid.items()],
     )
-    db.session.add(order)
+    db.session.execute(db.delete(OrderItem).where(OrderItem.cart_id == cart_id, OrderItem.quantity <= 0))
+    if db.session.execute(db.select(OrderItem.id).where(OrderItem.cart_id == cart_id).limit(1)).first():
+        refresh_cart_totals(Cart.id == cart_id, checkout_session_id=None, checkout_url=None, checkout_fingerprint=None,
+                            checkout_expires_at=None, updated_at=time.time())
+    else:
+        db.session.execute(db.delete(Cart).where(Cart.id == cart_id))
+
+
+def finalize_checkout(session_id, cart_id, user_id):
+    """Turn a paid checkout into an Order in one transaction. Returns False if the session was already finalized."""
+    created = db.session.execute(
+        dialect_insert()(Order)
+        .values(user_id=user_id, date=date.today().strftime("%m/%d/%Y"), created_at=datetime.now(timezone.utc), stripe_session_id=session_id)
+        .on_conflict_do_nothing(index_elements=[Order.stripe_session_id])
+    ).rowcount
+    if not created:
+        db.session.rollback()
+        return False
+
+    order_id = db.session.execute(db.select(Order.id).where(Order.stripe_session_id == session_id)).scalar()
+    held = session_reservations(session_id)
+    if held:
+        # Record what was paid for, not whatever is in the cart when the webhook arrives
+        paid = {}
+        for row in held:
+            paid[row.item_id] = paid.get(row.item_id, 0) + row.quantity
+        record_paid_lines(order_id, cart_id, paid, session_id)
+    elif cart_id:
+        # Sessions created before holds recorded their session: move the cart's lines onto the order
+        # (recording the price paid) and drop the empty ones with the cart
+        db.session.execute(
+            db.update(OrderItem).where(OrderItem.cart_id == cart_id, OrderItem.quantity > 0).values(
+                order_id=order_id, cart_id=None, price=db.select(Item.price).where(Item.id == OrderItem.item_id).scalar_subquery())
+        )
+        db.session.execute(db.delete(OrderItem).where(OrderItem.cart_id == cart_id))
+        db.session.execute(db.delete(Cart).where(Cart.id == cart_id))
+    short = commit_reservations(session_id, cart_id, held)
+    if short:
+        app.logger.warning("Checkout session %s was paid after its stock hold lapsed; oversold item(s) %s", session_id, short)
+    db.session.commit()
+    if user_id:
+        identities.invalidate(user_id)
+    return True
 
-    for item in cart.items:
-        if item.quantity > 0:
-            item.order_id = order.id
-        item.cart_id = Null
 
-    # Delete the Cart
-    db.session.delete(current_user.cart)
-    db.session.commit()
-    return render_template('success.html', logged_in=current_user.is_authenticated)
+def finalize_checkout_session(session):
+    metadata = session.get("metadata") or {}
+    cart_id = int(metadata["cart_id"]) if metadata.get("cart_id") else None
+    user_id = int(metadata["user_id"]) if metadata.get("user_id") else None
+    return finalize_checkout(session["id"], cart_id, user_id)
+
+
+@app.route('/stripe/webhook', methods=['POST'])
+def stripe_webhook():
+    payload = request.get_data(as_text=True)
+    try:
+        # Rejects signatures older than the SDK's default tolerance (5 minutes), so captured events can't be replayed later
+        event = stripe.Webhook.construct_event(payload, request.headers.get('Stripe-Signature', ''), app.config['STRIPE_WEBHOOK_SECRET']).to_dict()
+    except (ValueError, stripe.error.SignatureVerificationError):
+        return jsonify(error="Invalid payload or signature"), 400
+
+    if event["type"] == "checkout.session.completed":
+        session = event["data"]["object"]
+        if session.get("payment_status") in ("paid", "no_payment_required"):
+            finalize_checkout_session(session)
+    # Acknowledge everything else so Stripe stops retrying
+    return jsonify(received=True)
+
+
+def success_order(session_id):
+    if not session_id or not current_user.is_authenticated:
+        return None
+    return db.session.execute(
+        db.select(Order).where(Order.stripe_session_id == session_id, Order.user_id == current_user.id)
+    ).scalar()
+
+
+def should_finalize_from_redirect(session_id, order):
+    # Without a webhook endpoint configured (e.g. local development), finalize from the redirect instead
+    return order is None and session_id and current_user.is_authenticated and not app.config['STRIPE_WEBHOOK_SECRET']
+
+
+def retrieve_redirect_session(session_id):
+    try:
+        return stripe_api.checkout.Session.retrieve(session_id).to_dict()
+    except stripe.error.StripeError as e:
+        # Show the "being processed" page; the next visit to the success URL tries again
+        app.logger.warning("Could not retrieve checkout session %s: %s", session_id, e)
+        return None
+
+
+def finalize_redirect_session(session):
+    if session is None:
+        return None
+    if session.get("payment_status") in ("paid", "no_payment_required") and (session.get("metadata") or {}).get("user_id") == str(current_user.id):
+        finalize_checkout_session(session)
+        return db.session.execute(db.select(Order).where(Order.stripe_session_id == session["id"])).scalar()
+    return None
+
+
+@app.route('/success', methods=['GET', 'POST'])
+def success():
+    session_id = request.args.get('session_id')
+    order = success_order(session_id)
+    if should_finalize_from_redirect(session_id, order):
+        order = finalize_redirect_session(retrieve_redirect_session(session_id))
+    return render_template('success.html', logged_in=current_user.is_authenticated, order=order)
+
 
 
 @app.route('/cancel', methods=['GET'])
 def cancel():
+    # Put the abandoned checkout's stock back on the shelf, and close its session so it can't be paid without a hold
+    if current_user.is_authenticated:
+        cart = db.session.execute(db.select(Cart).where(Cart.user_id == current_user.id)).scalar()
+        if cart is not None:
+            if cart.checkout_session_id:
+                try:
+                    stripe_api.checkout.Session.expire(cart.checkout_session_id)
+                except stripe.error.StripeError as e:
+                    # Already completed or expired; a late payment retakes its stock in commit_reservations
+                    app.logger.warning("Could not expire checkout session %s: %s", cart.checkout_session_id, e)
+                cart.checkout_session_id = cart.checkout_url = cart.checkout_fingerprint = cart.checkout_expires_at = None
+            release_reservations(StockReservation.cart_id == cart.id)
+            db.session.commit()
     return render_template('cancel.html', logged_in=current_user.is_authenticated)
 
 
@@ -524,31 +2712,499 @@ def empty():
     return render_template('empty.html', logged_in=current_user.is_authenticated)
 
 
-#--- Product Category Pages ---#
-@app.route("/syrups")
-def syrup():
-    db_items = db.session.execute(db.select(Item).order_by('id')).scalars()
-    items = [item for item in db_items if item.category == "syrup"]
-    return render_template("index.html", logged_in=current_user.is_authenticated, items=items)
+#--- Maintenance ---#
+# Deletes ordered-items rows that belong to neither an order nor a cart, zero-quantity cart lines, and
+# carts idle for CART_TTL_DAYS (releasing their stock holds). Work is done in GC_BATCH_SIZE batches, each
+# its own short transaction, so shoppers never wait long on the write lock. Afterwards planner statistics
+# are refreshed and, on SQLite, free pages are handed back with an incremental vacuum.
+app.config.setdefault('CART_TTL_DAYS', float(os.getenv('CART_TTL_DAYS', 30)))
+app.config.setdefault('GC_BATCH_SIZE', int(os.getenv('GC_BATCH_SIZE', 500)))
+app.config.setdefault('GC_INTERVAL', float(os.getenv('GC_INTERVAL', 3600)))
+app.config.setdefault('GC_VACUUM_PAGES', int(os.getenv('GC_VACUUM_PAGES', 5000)))
+
+
+def delete_in_batches(select_ids, delete, batch_size):
+    """Repeatedly pick up to batch_size ids and delete them in their own transaction. Returns rows deleted."""
+    deleted = 0
+    while True:
+        ids = db.session.execute(select_ids.limit(batch_size)).scalars().all()
+        if not ids:
+            return deleted
+        deleted += delete(ids)
+        db.session.commit()
 
 
-@app.route("/hot-sauces")
-def hot_sauce():
-    db_items = db.session.execute(db.select(Item).order_by('id')).scalars()
-    items = [item for item in db_items if item.category == "hotsauce"]
-    return render_template("index.html", logged_in=current_user.is_authenticated, items=items)
+def delete_orphan_lines(ids):
+    return db.session.execute(db.delete(OrderItem).where(
+        OrderItem.id.in_(ids), OrderItem.order_id.is_(None),
+        db.or_(OrderItem.cart_id.is_(None), ~db.select(Cart.id).where(Cart.id == OrderItem.cart_id).exists()),
+    )).rowcount
+
+
+def delete_empty_lines(ids):
+    # Re-checked in the DELETE so a concurrent "+" on the same line wins
+    return db.session.execute(db.delete(OrderItem).where(OrderItem.id.in_(ids), OrderItem.quantity == 0, OrderItem.order_id.is_(None))).rowcount
+
+
+def stale_cart_criteria(cutoff):
+    # Carts with a Checkout Session still open are left alone until it expires
+    return (Cart.updated_at < cutoff, db.or_(Cart.checkout_expires_at.is_(None), Cart.checkout_expires_at < time.time()))
+
+
+def delete_stale_carts(ids, cutoff):
+    deleted = db.session.execute(
+        db.delete(Cart).where(Cart.id.in_(ids), *stale_cart_criteria(cutoff)).returning(Cart.id, Cart.user_id)
+    ).all()
+    cart_ids = [cart_id for cart_id, user_id in deleted]
+    if cart_ids:
+        release_reservations(StockReservation.cart_id.in_(cart_ids))
+        db.session.execute(db.delete(OrderItem).where(OrderItem.cart_id.in_(cart_ids), OrderItem.order_id.is_(None)))
+    for cart_id, user_id in deleted:
+        identities.invalidate(user_id)
+    return len(deleted)
+
+
+def compact_database(vacuum_pages=None):
+    """Refresh planner statistics and return free pages to the OS. Returns pages freed (SQLite only)."""
+    vacuum_pages = vacuum_pages or app.config['GC_VACUUM_PAGES']
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if db.engine.dialect.name != "sqlite":
+            connection.exec_driver_sql('VACUUM ANALYZE "ordered-items", carts, "stock-reservations"')
+            return 0
+        free_pages = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+        connection.exec_driver_sql("ANALYZE")
+        if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+            # Databases created before incremental auto_vacuum need one full VACUUM (collect-garbage --convert)
+            return 0
+        # sqlite3's execute() steps a statement only once (one page here); executescript runs it to completion
+        connection.connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)})")
+        return free_pages - connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+
+
+def collect_garbage(cart_ttl_days=None, batch_size=None):
+    """Delete orphaned cart lines and idle carts, then compact. Returns a report of what was reclaimed."""
+    cart_ttl_days = cart_ttl_days or app.config['CART_TTL_DAYS']
+    batch_size = batch_size or app.config['GC_BATCH_SIZE']
+    cutoff = time.time() - cart_ttl_days * 86400
+    start = time.perf_counter()
+
+    report = {}
+    report["stale_carts"] = delete_in_batches(
+        db.select(Cart.id).where(*stale_cart_criteria(cutoff)).order_by(Cart.id),
+        lambda ids: delete_stale_carts(ids, cutoff), batch_size)
+    report["orphan_lines"] = delete_in_batches(
+        db.select(OrderItem.id)
+        .outerjoin(Cart, Cart.id == OrderItem.cart_id)
+        .where(OrderItem.order_id.is_(None), Cart.id.is_(None))
+        .order_by(OrderItem.id),
+        delete_orphan_lines, batch_size)
+    report["empty_lines"] = delete_in_batches(
+        db.select(OrderItem.id).where(OrderItem.quantity == 0, OrderItem.order_id.is_(None)).order_by(OrderItem.id),
+        delete_empty_lines, batch_size)
+    report["pages_freed"] = compact_database()
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    return report
+
+
+class MaintenanceWorker(threading.Thread):
+    def __init__(self, interval=None):
+        super().__init__(name="maintenance", daemon=True)
+        self.interval = interval or app.config['GC_INTERVAL']
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with app.app_context():
+                try:
+                    app.logger.info("Maintenance: %s", collect_garbage())
+                except Exception as e:
+                    app.logger.exception("Maintenance failed: %s", e)
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        self.stopped.set()
+
+
+@app.cli.command("collect-garbage")
+@click.option("--cart-ttl-days", type=float, help="Delete carts idle for this many days (default CART_TTL_DAYS).")
+@click.option("--batch-size", type=int, help="Rows deleted per transaction (default GC_BATCH_SIZE).")
+@click.option("--convert", is_flag=True, help="SQLite: switch an existing database to incremental auto_vacuum (runs a full VACUUM once).")
+def collect_garbage_command(cart_ttl_days, batch_size, convert):
+    """Delete orphaned cart lines and idle carts, then refresh statistics and compact the database."""
+    if convert and db.engine.dialect.name == "sqlite":
+        with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            connection.exec_driver_sql("VACUUM")
+    report = collect_garbage(cart_ttl_days, batch_size)
+    click.echo(f"Deleted {report['stale_carts']} idle cart(s), {report['orphan_lines']} orphaned and "
+               f"{report['empty_lines']} empty cart line(s); freed {report['pages_freed']} page(s) in {report['seconds']}s")
+
+
+#--- Admin Reports ---#
+# Aggregates are computed in SQL (GROUP BY / SUM) so the pages stay fast as ordered-items grows
+app.config.setdefault('REPORT_PAGE_SIZE', int(os.getenv('REPORT_PAGE_SIZE', 50)))
+
+
+def line_total():
+    # Fall back to the current item price for lines ordered before prices were recorded
+    return OrderItem.quantity * db.func.coalesce(OrderItem.price, Item.price)
+
+
+def report_page(query, key_column):
+    """Keyset-paginate a report query on key_column (ascending). Returns (rows, next_after)."""
+    page_size = app.config['REPORT_PAGE_SIZE']
+    after = request.args.get('after', type=int)
+    if after is not None:
+        query = query.where(key_column > after)
+    rows = db.session.execute(query.order_by(key_column).limit(page_size + 1)).all()
+    next_after = rows[page_size - 1][0] if len(rows) > page_size else None
+    return rows[:page_size], next_after
+
+
+@app.route("/admin/inventory")
+@admin_only
+def inventory_report():
+    held = (
+        db.select(StockReservation.item_id, db.func.sum(StockReservation.quantity).label("held"))
+        .where(StockReservation.status == "held")
+        .group_by(StockReservation.item_id)
+        .subquery()
+    )
+    sold = (
+        db.select(OrderItem.item_id, db.func.sum(OrderItem.quantity).label("sold"))
+        .where(OrderItem.order_id.is_not(None))
+        .group_by(OrderItem.item_id)
+        .subquery()
+    )
+    query = (
+        db.select(Item.id, Item.name, Item.category, Item.stock,
+                  db.func.coalesce(held.c.held, 0), db.func.coalesce(sold.c.sold, 0))
+        .outerjoin(held, held.c.item_id == Item.id)
+        .outerjoin(sold, sold.c.item_id == Item.id)
+    )
+    rows, next_after = report_page(query, Item.id)
+    return render_template("admin_report.html", logged_in=current_user.is_authenticated, title="Inventory",
+                           headers=["ID", "Name", "Category", "In Stock", "Held", "Sold"], rows=rows, next_after=next_after)
 
 
-@app.route("/jams")
-def jam():
-    db_items = db.session.execute(db.select(Item).order_by('id')).scalars()
-    items = [item for item in db_items if item.category == "jam"]
-    return render_template("index.html", logged_in=current_user.is_authenticated, items=items)
+@app.route("/admin/customers")
+@admin_only
+def customer_report():
+    totals = (
+        db.select(Order.user_id, db.func.count(db.distinct(Order.id)).label("orders"),
+                  db.func.sum(OrderItem.quantity).label("units"), db.func.sum(line_total()).label("spent"),
+                  db.func.max(Order.created_at).label("last_order"))
+        .join(OrderItem, OrderItem.order_id == Order.id)
+        # Outer join: lines for since-deleted items still count at their recorded price
+        .outerjoin(Item, Item.id == OrderItem.item_id)
+        .group_by(Order.user_id)
+        .subquery()
+    )
+    query = (
+        db.select(User.id, User.username, User.email, db.func.coalesce(totals.c.orders, 0),
+                  db.func.coalesce(totals.c.units, 0), db.func.coalesce(totals.c.spent, 0) / 100.0, totals.c.last_order)
+        .outerjoin(totals, totals.c.user_id == User.id)
+    )
+    rows, next_after = report_page(query, User.id)
+    return render_template("admin_report.html", logged_in=current_user.is_authenticated, title="Customers",
+                           headers=["ID", "Username", "Email", "Orders", "Units", "Spent (USD)", "Last Order"], rows=rows, next_after=next_after)
 
 
-if __name__ == '__main__':
-    app.run(debug=True)
+@app.route("/admin/sales")
+@admin_only
+def sales_report():
+    # Daily totals over a date range (default: the last 30 days); the created_at index bounds the scan
+    try:
+        end = datetime.strptime(request.args['end'], "%Y-%m-%d") if request.args.get('end') else datetime.now(timezone.utc).replace(tzinfo=None)
+        start = datetime.strptime(request.args['start'], "%Y-%m-%d") if request.args.get('start') else end - timedelta(days=30)
+    except ValueError:
+        return abort(400)
+    day = db.func.date(Order.created_at)
+    rows = db.session.execute(
+        db.select(day, db.func.count(db.distinct(Order.id)), db.func.sum(OrderItem.quantity), db.func.sum(line_total()) / 100.0)
+        .join(OrderItem, OrderItem.order_id == Order.id)
+        # Outer join: lines for since-deleted items still count at their recorded price
+        .outerjoin(Item, Item.id == OrderItem.item_id)
+        .where(Order.created_at >= start.replace(tzinfo=timezone.utc), Order.created_at < (end + timedelta(days=1)).replace(tzinfo=timezone.utc))
+        .group_by(day)
+        .order_by(day)
+    ).all()
+    return render_template("admin_report.html", logged_in=current_user.is_authenticated, title=f"Sales {start:%Y-%m-%d} to {end:%Y-%m-%d}",
+                           headers=["Day", "Orders", "Units", "Revenue (USD)"], rows=rows, next_after=None)
+
+
+#--- Product Category Pages ---#
+app.config.setdefault('CATEGORY_PAGE_SIZE', int(os.getenv('CATEGORY_PAGE_SIZE', 24)))
+
+
+@app.context_processor
+def inject_categories():
+    return dict(categories=CATEGORY_CHOICES)
+
+
+@app.route("/category/<string:category>")
+def category(category):
+    if category not in CATEGORIES:
+        return abort(404)
+
+    page_size = app.config['CATEGORY_PAGE_SIZE']
+    after = request.args.get('after', 0, type=int)
+    version = catalog.version()
+
+    def render():
+        # Keyset pagination: fetch one row past the page to know whether a next page exists
+        items = db.session.execute(
+            db.select(Item)
+            .where(Item.category == category, Item.id > after)
+            .order_by(Item.id)
+            .limit(page_size + 1)
+        ).scalars().all()
+
+        next_after = items[page_size - 1].id if len(items) > page_size else None
+        grid = item_grid(version, items[:page_size], "category", category, after, page_size)
+        return render_template("index.html", logged_in=current_user.is_authenticated, grid=grid, category=category, next_after=next_after)
+
+    return cached_page(make_etag("category", version, category, after, page_size, viewer_key()), render)
+
+
+# The category pages used to live at their own paths; send old links and bookmarks to the new ones
+@app.route("/syrups", defaults={"category": "syrup"})
+@app.route("/hot-sauces", defaults={"category": "hotsauce"})
+@app.route("/jams", defaults={"category": "jam"})
+def legacy_category(category):
+    return redirect(url_for("category", category=category, **request.args), code=301)
+
+
+#--- App Entry Point ---#
+# The module still builds the app itself at import: config, the database engine, LoginManager, Bootstrap and the
+# Stripe client are set up above. What it no longer does on import is touch the database (`flask init-db` creates
+# and migrates the schema). create_app() is the serving entry point (e.g. `gunicorn "main:create_app()"`): it adds
+# only what a serving process needs on top of that, namely CKEditor, init-db when AUTO_INIT_DB=1, and the
+# background workers enabled by env flags, so plain `flask --app main <command>` CLI runs stay free of worker threads.
+app.config.setdefault('AUTO_INIT_DB', os.getenv('AUTO_INIT_DB') == '1')
+background_workers = []
+app_started = False
+app_start_lock = threading.Lock()
+
+
+def create_app():
+    """Load CKEditor, run init-db if AUTO_INIT_DB is set and start the enabled background workers; returns the
+    module's app. Safe to call more than once."""
+    global app_started
+    with app_start_lock:
+        if app_started:
+            return app
+        app_started = True
+
+        # Nothing renders an editor yet, so the extension is only loaded by processes that serve requests
+        from flask_ckeditor import CKEditor
+        CKEditor(app)
+
+        if app.config['AUTO_INIT_DB']:
+            with app.app_context():
+                init_db()
+
+        workers = [("STRIPE_SYNC_WORKER", StripeSyncWorker), ("STOCK_SWEEPER", ReservationSweeper), ("GC_WORKER", MaintenanceWorker)]
+        for flag, worker_class in workers:
+            if os.getenv(flag) == '1':
+                worker = worker_class()
+                worker.start()
+                background_workers.append(worker)
+    return app
+
+
+
+#--- ASGI Serving ---#
+# `uvicorn --factory "main:create_asgi_app"` serves the app over ASGI (needs asgiref and httpx). Flask views run
+# on a pool of ASGI_THREADS threads, as under gunicorn's gthread worker, except checkout and the success redirect:
+# their database work runs on the pool in short steps and the Stripe round trip in between is awaited on the event
+# loop through a pooled async client, so a slow Stripe ties up open sockets rather than the pool's threads.
+app.config.setdefault('ASGI_THREADS', int(os.getenv('ASGI_THREADS', 8)))
+
+
+class AsyncStripe:
+    """Pooled async Stripe client for the ASGI event loop. Like stripe_api, a call waits up to STRIPE_TIMEOUT for
+    one of STRIPE_MAX_CONCURRENCY slots and raises StripeBusy if none frees up."""
+
+    def __init__(self):
+        self.client = None
+
+    async def call(self, operation, request):
+        """Await request(client), e.g. ``lambda client: client.v1.checkout.sessions.create_async(params)``."""
+        if self.client is None:
+            # Built on first use so the connection pool belongs to the serving loop
+            base = app.config['STRIPE_API_BASE']
+            self.client = stripe.StripeClient(stripe.api_key, http_client=stripe.HTTPXClient(timeout=app.config['STRIPE_TIMEOUT']),
+                                              base_addresses={"api": base} if base else None)
+            self.slots = asyncio.Semaphore(app.config['STRIPE_MAX_CONCURRENCY'])
+        started = time.perf_counter()
+        failed = True
+        try:
+            try:
+                await asyncio.wait_for(self.slots.acquire(), app.config['STRIPE_TIMEOUT'])
+            except asyncio.TimeoutError:
+                raise StripeBusy(f"No free Stripe slot for {operation}")
+            try:
+                result = await request(self.client)
+            finally:
+                self.slots.release()
+            failed = False
+            return result
+        finally:
+            observe_stripe_call(operation, started, failed)
+
+
+async_stripe = AsyncStripe()
+
+
+def run_request_step(environ, step, started):
+    """Run step() inside a Flask request built from environ, with the app's request hooks. step returns
+    (response, None) to answer the request, or (None, value) to hand value back to the event loop."""
+    with app.request_context(environ):
+        try:
+            try:
+                rv = app.preprocess_request()
+                # Time the whole request, not just this step
+                g.request_started = started
+                if rv is None:
+                    if request.routing_exception is not None:
+                        app.raise_routing_exception(request)
+                    rv, value = step()
+                    if rv is None:
+                        return None, value
+            except Exception as e:
+                rv = app.handle_user_exception(e)
+            return app.finalize_request(rv), None
+        except Exception as e:
+            return app.handle_exception(e), None
+
+
+def prepare_async_checkout():
+    response, checkout = prepare_checkout()
+    if response is None:
+        checkout['params'] = checkout_session_params(checkout)
+    return response, checkout
+
 
+async def async_create_checkout_session(in_request):
+    response, checkout = await in_request(prepare_async_checkout)
+    if response is not None:
+        return response
+    try:
+        checkout_session = await async_stripe.call(
+            "stripe.checkout.Session.create", lambda client: client.v1.checkout.sessions.create_async(checkout['params']))
+    except Exception as e:
+        error = e
+        response, _ = await in_request(lambda: (checkout_failed(checkout, error), None))
+        return response
+    response, _ = await in_request(lambda: (store_checkout_session(checkout, checkout_session), None))
+    return response
+
+
+def lookup_success_order():
+    session_id = request.args.get('session_id')
+    order = success_order(session_id)
+    if should_finalize_from_redirect(session_id, order):
+        return None, session_id
+    return render_template('success.html', logged_in=current_user.is_authenticated, order=order), None
+
+
+async def async_success(in_request):
+    response, session_id = await in_request(lookup_success_order)
+    if response is not None:
+        return response
+    try:
+        checkout_session = await async_stripe.call(
+            "stripe.checkout.Session.retrieve", lambda client: client.v1.checkout.sessions.retrieve_async(session_id))
+        session = checkout_session.to_dict()
+    except stripe.error.StripeError as e:
+        app.logger.warning("Could not retrieve checkout session %s: %s", session_id, e)
+        session = None
+    response, _ = await in_request(lambda: (render_template(
+        'success.html', logged_in=current_user.is_authenticated, order=finalize_redirect_session(session)), None))
+    return response
+
+
+ASYNC_VIEWS = {"/create-checkout-session": async_create_checkout_session, "/success": async_success}
+
+
+def create_asgi_app():
+    """ASGI entry point: create_app() served over ASGI, with the Stripe-bound views in ASYNC_VIEWS awaited on the loop."""
+    from asgiref.sync import sync_to_async
+    from asgiref.wsgi import WsgiToAsgiInstance
+
+    create_app()
+    pool = ThreadPoolExecutor(max_workers=app.config['ASGI_THREADS'], thread_name_prefix="asgi")
+
+    class PooledWsgiToAsgi(WsgiToAsgiInstance):
+        # asgiref runs WSGI apps on one shared thread by default; use the pool instead
+        run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__["run_wsgi_app"].func, thread_sensitive=False, executor=pool)
+
+    async def asgi_app(scope, receive, send):
+        wsgi = PooledWsgiToAsgi(app)
+        view = ASYNC_VIEWS.get(scope["path"]) if scope["type"] == "http" else None
+        if view is None:
+            return await wsgi(scope, receive, send)
+
+        started = time.perf_counter()
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        wsgi.scope = scope
+        loop = asyncio.get_running_loop()
+
+        def in_request(step):
+            return loop.run_in_executor(pool, run_request_step, wsgi.build_environ(scope, io.BytesIO(body)), step, started)
+
+        response = await view(in_request)
+        await send({"type": "http.response.start", "status": response.status_code,
+                    "headers": [(name.lower().encode("latin1"), value.encode("latin1")) for name, value in response.headers.items()]})
+        await send({"type": "http.response.body", "body": response.get_data()})
+
+    return asgi_app
+
+
+# Runs in a fresh interpreter per sample so nothing is already imported or cached
+STARTUP_PROBE = """
+import json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.create_app()
+created = time.perf_counter()
+status = app.test_client().get("/").status_code
+print(json.dumps({"import": imported - started, "create_app": created - imported,
+                  "first_request": time.perf_counter() - created, "status": status}))
+"""
+
+
+@app.cli.command("bench-startup")
+@click.option("--runs", default=10, help="Number of cold starts to time.")
+def bench_startup(runs):
+    """Time cold worker boots: process start, importing main.py, create_app() and the first request."""
+    init_db()
+    env = dict(os.environ, STRIPE_SYNC_WORKER="0", STOCK_SWEEPER="0", GC_WORKER="0", AUTO_INIT_DB="0")
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", STARTUP_PROBE], cwd=app.root_path, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        sample = json.loads(output.splitlines()[-1])
+        sample["process"] = time.perf_counter() - start
+        samples.append(sample)
+
+    click.echo(f"{runs} cold starts, first request status {samples[-1]['status']}")
+    for phase in ("import", "create_app", "first_request", "process"):
+        times = sorted(sample[phase] * 1000 for sample in samples)
+        click.echo(f"{phase}: median {times[len(times) // 2]:.1f} ms, max {times[-1]:.1f} ms")
 
-# TODO 7) Add Inventory page for admin
-# TODO 8) Add Customer list page for admin
+
+if __name__ == '__main__':
+    # The dev server sets up the schema itself, so `python main.py` works on a fresh checkout
+    with app.app_context():
+        init_db()
+    create_app().run(debug=True)
@@ -0,0 +1,47 @@
+// Batches +/- clicks on the item page into one JSON request instead of a full page reload per click
+const endpoint = document.querySelector("#cart-script").dataset.endpoint;
+const pending = {};
+let timer = null;
+
+document.querySelectorAll(".cart-step").forEach((link) => {
+  link.addEventListener("click", (event) => {
+    event.preventDefault();
+    const itemId = link.dataset.itemId;
+    pending[itemId] = (pending[itemId] || 0) + Number(link.dataset.delta);
+
+    // Show the change right away; the server response corrects it if needed
+    const box = document.querySelector(`#quantity-${itemId} h4`);
+    box.textContent = Math.max(Number(box.textContent) + Number(link.dataset.delta), 0);
+
+    clearTimeout(timer);
+    timer = setTimeout(flush, 300);
+  });
+});
+
+// Sends the accumulated deltas and writes back the quantities stored on the server
+async function flush() {
+  const changes = Object.entries(pending).map(([item_id, delta]) => ({ item_id: Number(item_id), delta }));
+  Object.keys(pending).forEach((itemId) => delete pending[itemId]);
+  if (changes.length === 0) {
+    return;
+  }
+
+  const response = await fetch(endpoint, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ changes }),
+  });
+  if (!response.ok) {
+    window.location.reload();
+    return;
+  }
+
+  const { quantities, cart } = await response.json();
+  Object.entries(quantities).forEach(([itemId, quantity]) => {
+    document.querySelector(`#quantity-${itemId} h4`).textContent = quantity;
+  });
+  const badge = document.querySelector("#cart-badge");
+  if (badge && cart) {
+    badge.textContent = cart.item_count;
+  }
+}
@@ -0,0 +1,44 @@
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+# main.py reads its settings on import, so point it at a throwaway SQLite file (and keep workers off) first
+DB_DIR = tempfile.mkdtemp(prefix="storefront-test-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(DB_DIR, 'test.db')}"
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("DOMAIN", "http://localhost/")
+os.environ.pop("STRIPE_WEBHOOK_SECRET", None)
+for flag in ("STRIPE_SYNC_WORKER", "STOCK_SWEEPER", "GC_WORKER", "AUTO_INIT_DB"):
+    os.environ[flag] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    main.app.config.update(TESTING=True, WTF_CSRF_ENABLED=False, ENFORCE_QUERY_BUDGET=True)
+    with main.app.app_context():
+        main.init_db()
+    yield main.app
+    with main.app.app_context():
+        main.db.engine.dispose()
+    shutil.rmtree(DB_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def make_item(app):
+    def make(**values):
+        values = dict(dict(stripe_prod_id=f"prod_{uuid.uuid4().hex}", stripe_price_id=f"price_{uuid.uuid4().hex}",
+                           name=f"item-{uuid.uuid4().hex}", category="syrup", price=500, unit="oz", unit_amt=8,
+                           description="test item", img_url="http://example.com/item.jpg", stock=100), **values)
+        with app.app_context():
+            item = main.Item(**values)
+            main.db.session.add(item)
+            main.db.session.commit()
+            return item.id
+    return make
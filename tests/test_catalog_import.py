@@ -0,0 +1,42 @@
+import io
+import json
+import uuid
+
+import main
+
+def row(**values):
+    return dict(dict(name=f"item-{uuid.uuid4().hex}", category="jam", price=650, unit="oz", unit_amt=8,
+                     img_url="http://example.com/jam.jpg", description="test jam", stock=5), **values)
+
+def test_unreadable_jsonl_lines_are_reported_per_line(app):
+    good, later = row(), row()
+    upload = b"\n".join([
+        json.dumps(good).encode(),
+        b"{not json",
+        b"[1, 2]",
+        b"",
+        json.dumps(row(description="caf\xe9")).encode().replace(b"\\u00e9", b"\xe9"),
+        json.dumps(later).encode(),
+    ]) + b"\n"
+    with app.app_context():
+        imported, errors, _ = main.import_catalog(io.BytesIO(upload), "jsonl")
+        names = set(main.db.session.execute(main.db.select(main.Item.name).where(main.Item.name.in_([good["name"], later["name"]]))).scalars())
+    assert imported == 2
+    assert names == {good["name"], later["name"]}
+    assert [error["row"] for error in errors] == [2, 3, 5]
+    assert errors[0]["errors"]["line"].startswith("Invalid JSON")
+    assert errors[1]["errors"]["line"] == "Expected a JSON object"
+    assert errors[2]["errors"]["line"].startswith("Not valid UTF-8")
+
+def test_csv_rows_report_their_line_in_the_file(app):
+    good = row()
+    header = ",".join(main.CATALOG_FIELDS)
+    lines = [header, ",".join(str(good[field]) for field in main.CATALOG_FIELDS),
+             ",".join(str(row(price="lots")[field]) for field in main.CATALOG_FIELDS)]
+    upload = ("\r\n".join(lines) + "\r\n").encode() + b"bad\xff,line\r\n"
+    with app.app_context():
+        imported, errors, _ = main.import_catalog(io.BytesIO(upload), "csv")
+    assert imported == 1
+    assert [error["row"] for error in errors] == [3, 4]
+    assert "price" in errors[0]["errors"]
+    assert errors[1]["errors"]["line"].startswith("Not valid UTF-8")
@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import types
+import uuid
+
+import pytest
+import stripe
+from flask import url_for
+from sqlalchemy import event
+
+import main
+
+# Pages whose statement count must not grow with the number of items (ENFORCE_QUERY_BUDGET is on under test,
+# so a view that goes over its @query_budget raises instead of responding)
+SIZES = (1, 12)
+
+
+@pytest.fixture
+def shopper(app):
+    """A logged-in test client and its user id."""
+    client = app.test_client()
+    name = uuid.uuid4().hex
+    client.post("/sign-up", data=dict(username=name, email=f"{name}@example.com", password="pw"))
+    client.post("/login", data=dict(email=f"{name}@example.com", password="pw"))
+    with app.app_context():
+        user_id = main.db.session.execute(main.db.select(main.User.id).where(main.User.username == name)).scalar()
+    # Warm the identity cache so the first measured request doesn't also pay for loading the user
+    client.get("/cart")
+    return client, user_id
+
+
+@contextmanager
+def count_statements(app):
+    statements = []
+    with app.app_context():
+        engine = main.db.engine
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+
+def place_order(app, make_item, user_id, lines):
+    item_ids = [make_item() for _ in range(lines)]
+    with app.app_context():
+        order = main.Order(user_id=user_id, created_at=datetime.now(timezone.utc), stripe_session_id=f"cs_{uuid.uuid4().hex}")
+        order.items = [main.OrderItem(item_id=item_id, quantity=2, price=500) for item_id in item_ids]
+        main.db.session.add(order)
+        main.db.session.commit()
+        return order.id
+
+
+def statements_for(app, client, path):
+    with count_statements(app) as statements:
+        response = client.get(path)
+    assert response.status_code in (200, 303), response.status_code
+    return len(statements)
+
+
+def test_order_page_query_count_is_constant(app, make_item, shopper):
+    client, user_id = shopper
+    counts = []
+    for size in SIZES:
+        order_id = place_order(app, make_item, user_id, size)
+        with app.test_request_context():
+            path = url_for("order", order_id=order_id)
+        counts.append(statements_for(app, client, path))
+    assert counts[0] == counts[1]
+
+
+def test_my_orders_query_count_is_constant(app, make_item, shopper):
+    client, user_id = shopper
+    with app.test_request_context():
+        path = url_for("my_orders")
+    counts = []
+    for size in SIZES:
+        for _ in range(size):
+            place_order(app, make_item, user_id, 2)
+        counts.append(statements_for(app, client, path))
+    assert counts[0] == counts[1]
+
+
+def test_checkout_query_count_is_constant(app, make_item, shopper, monkeypatch):
+    client, user_id = shopper
+
+    def create(**params):
+        return types.SimpleNamespace(id=f"cs_{uuid.uuid4().hex}", url="https://checkout.stripe.test/pay", expires_at=params["expires_at"])
+    monkeypatch.setattr(stripe.checkout.Session, "create", create)
+
+    counts = []
+    for size in SIZES:
+        changes = [{"item_id": make_item(), "delta": 1} for _ in range(size)]
+        # Start each size from a fresh cart holding exactly `size` lines
+        with app.app_context():
+            main.db.session.execute(main.db.delete(main.OrderItem).where(
+                main.OrderItem.cart_id.in_(main.db.select(main.Cart.id).where(main.Cart.user_id == user_id))))
+            main.db.session.commit()
+        assert client.post("/cart/items", json={"changes": changes}).status_code == 200
+        counts.append(statements_for(app, client, "/create-checkout-session"))
+    assert counts[0] == counts[1]
@@ -0,0 +1,58 @@
+import threading
+
+import main
+
+
+def test_concurrent_checkouts_never_oversell(app, make_item):
+    threads, stock, attempts = 16, 50, 20
+    item_id = make_item(stock=stock)
+    sold = []
+    errors = []
+
+    def buyer(buyer_id):
+        with app.app_context():
+            try:
+                for attempt in range(attempts):
+                    # Each attempt is its own cart, so every successful hold is a separate sale
+                    try:
+                        main.reserve_stock(-(buyer_id * attempts + attempt + 1), {item_id: 1})
+                    except main.OutOfStock:
+                        continue
+                    sold.append(1)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                main.db.session.remove()
+
+    workers = [threading.Thread(target=buyer, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    with app.app_context():
+        remaining = main.db.session.execute(main.db.select(main.Item.stock).where(main.Item.id == item_id)).scalar()
+        held = main.db.session.execute(
+            main.db.select(main.db.func.sum(main.StockReservation.quantity))
+            .where(main.StockReservation.item_id == item_id, main.StockReservation.status == "held")
+        ).scalar()
+
+    assert not errors
+    assert len(sold) == stock
+    assert held == stock
+    assert remaining == 0
+
+
+def test_reserve_stock_is_all_or_nothing(app, make_item):
+    plenty, scarce = make_item(stock=10), make_item(stock=1)
+    with app.app_context():
+        try:
+            main.reserve_stock(-10_001, {plenty: 2, scarce: 2})
+        except main.OutOfStock as e:
+            assert e.item_id == scarce
+        else:
+            raise AssertionError("expected OutOfStock")
+        stock = dict(main.db.session.execute(
+            main.db.select(main.Item.id, main.Item.stock).where(main.Item.id.in_([plenty, scarce]))
+        ).all())
+    assert stock == {plenty: 10, scarce: 1}
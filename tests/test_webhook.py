@@ -0,0 +1,88 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+
+import pytest
+
+import main
+
+SECRET = "whsec_test"
+
+@pytest.fixture
+def webhook_secret(app, monkeypatch):
+    monkeypatch.setitem(app.config, "STRIPE_WEBHOOK_SECRET", SECRET)
+    return SECRET
+
+def signed(payload, secret=SECRET, timestamp=None):
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return {"Stripe-Signature": f"t={timestamp},v1={signature}", "Content-Type": "application/json"}
+
+def paid_session_event(app, make_item, quantity=2):
+    """A checkout.session.completed event for a session holding `quantity` of a fresh item. Returns (payload, session id, item id)."""
+    item_id = make_item(stock=10)
+    session_id = f"cs_test_{uuid.uuid4().hex}"
+    with app.app_context():
+        main.reserve_stock(-int(uuid.uuid4().int % 1_000_000) - 1, {item_id: quantity}, session_id)
+    payload = json.dumps({
+        "id": f"evt_{uuid.uuid4().hex}",
+        "object": "event",
+        "type": "checkout.session.completed",
+        "data": {"object": {"id": session_id, "object": "checkout.session", "payment_status": "paid", "metadata": {}}},
+    })
+    return payload, session_id, item_id
+
+def order_lines(app, session_id):
+    with app.app_context():
+        return main.db.session.execute(
+            main.db.select(main.OrderItem.item_id, main.OrderItem.quantity)
+            .join(main.Order, main.Order.id == main.OrderItem.order_id)
+            .where(main.Order.stripe_session_id == session_id)
+        ).all()
+
+def test_signed_event_creates_the_order(app, make_item, webhook_secret):
+    payload, session_id, item_id = paid_session_event(app, make_item)
+    response = app.test_client().post("/stripe/webhook", data=payload, headers=signed(payload))
+    assert response.status_code == 200
+    assert order_lines(app, session_id) == [(item_id, 2)]
+    with app.app_context():
+        assert main.db.session.execute(main.db.select(main.Item.stock).where(main.Item.id == item_id)).scalar() == 8
+
+def test_replayed_events_finalize_once(app, make_item, webhook_secret):
+    payload, session_id, item_id = paid_session_event(app, make_item)
+    statuses = []
+
+    def deliver():
+        statuses.append(app.test_client().post("/stripe/webhook", data=payload, headers=signed(payload)).status_code)
+
+    # Stripe retries and may deliver the same event more than once at the same time
+    deliveries = [threading.Thread(target=deliver) for _ in range(8)]
+    for delivery in deliveries:
+        delivery.start()
+    for delivery in deliveries:
+        delivery.join()
+    deliver()
+
+    assert statuses == [200] * 9
+    assert order_lines(app, session_id) == [(item_id, 2)]
+    with app.app_context():
+        orders = main.db.session.execute(
+            main.db.select(main.db.func.count(main.Order.id)).where(main.Order.stripe_session_id == session_id)
+        ).scalar()
+    assert orders == 1
+
+def test_stale_signature_is_rejected(app, make_item, webhook_secret):
+    payload, session_id, _ = paid_session_event(app, make_item)
+    headers = signed(payload, timestamp=int(time.time()) - 10 * 24 * 3600)
+    assert app.test_client().post("/stripe/webhook", data=payload, headers=headers).status_code == 400
+    assert order_lines(app, session_id) == []
+
+def test_bad_signature_is_rejected(app, make_item, webhook_secret):
+    payload, session_id, _ = paid_session_event(app, make_item)
+    headers = signed(payload, secret="whsec_someone_else")
+    assert app.test_client().post("/stripe/webhook", data=payload, headers=headers).status_code == 400
+    assert app.test_client().post("/stripe/webhook", data=payload).status_code == 400
+    assert order_lines(app, session_id) == []